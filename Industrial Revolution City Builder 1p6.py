@@ -1,5 +1,27 @@
+import os
+import sys
+
+# Headless runs and the server (see run_headless, run_server) need SDL's
+# dummy drivers, which have to be picked before pygame loads
+if "--headless" in sys.argv or "--server" in sys.argv:
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")  # Keep stdout clean for the metrics JSON
+
 import pygame
 import random
+import argparse
+import asyncio
+import struct
+import zlib
+import json
+import time
+import traceback
+import threading
+import queue
+import heapq
+from collections import namedtuple, deque
+import numpy as np
 
 pygame.init()
 pygame.mixer.init()
@@ -8,10 +30,14 @@ pygame.mixer.init()
 WIDTH = 800
 HEIGHT = 600
 GRID_SIZE = 20
-GRID_WIDTH = WIDTH // GRID_SIZE  # 40
-GRID_HEIGHT = HEIGHT // GRID_SIZE  # 30
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("Industrial Revolution City Builder")
+VIEW_WIDTH = WIDTH // GRID_SIZE  # 40 tiles visible across
+VIEW_HEIGHT = HEIGHT // GRID_SIZE  # 30 tiles visible down
+GRID_WIDTH = 160  # Map size in tiles; the camera scrolls over it
+GRID_HEIGHT = 120
+CAMERA_SPEED = 10  # Pixels per frame while an arrow key is held
+ZOOM_TILE_SIZES = (20, 10, 5)  # Screen pixels per tile at each zoom level; 5 shows the whole map
+TILE_LOD_SIZE = 5  # At or below this tile size, draw one pixel per tile instead of buildings
+SPRITE_MARGIN = 20  # Room above scaled sprites for factory chimneys
 
 # Colors
 WHITE = (255, 255, 255)
@@ -38,6 +64,21 @@ BUILDINGS = {
     "railroad": {"color": DARK_GRAY, "grid_size": (1, 1), "base_cost": 25, "current_cost": 25, "workers": 0}
 }
 
+# Building type codes. The grid stores these, and hot code compares them
+# instead of the type strings. Code 0 marks an empty tile.
+EMPTY = 0
+HOUSE = 1
+FARM = 2
+MINE = 3
+FACTORY = 4
+RAILROAD = 5
+BUILDING_TYPES = [None, "house", "farm", "mine", "factory", "railroad"]
+TYPE_CODES = {name: code for code, name in enumerate(BUILDING_TYPES) if name}
+
+# Static parts of BUILDINGS compiled into tables indexed by type code
+BUILDING_SIZES = [(0, 0)] + [BUILDINGS[name]["grid_size"] for name in BUILDING_TYPES[1:]]
+BUILDING_COLORS = [None] + [BUILDINGS[name]["color"] for name in BUILDING_TYPES[1:]]
+
 # Worker constants
 WORKERS_PER_HOUSE = 5
 WORKERS_PER_FACTORY = 10
@@ -53,6 +94,134 @@ HOUSE_CAPACITY = 5
 # Worker constants (unchanged)
 HOUSE_CAPACITY = 5
 
+# Pollution field settings
+POLLUTION_CELL = 2  # Tiles per pollution cell side (coarse grid keeps big maps cheap)
+POLLUTION_WIDTH = (GRID_WIDTH + POLLUTION_CELL - 1) // POLLUTION_CELL
+POLLUTION_HEIGHT = (GRID_HEIGHT + POLLUTION_CELL - 1) // POLLUTION_CELL
+POLLUTION_TICK = 500  # Milliseconds between diffusion steps
+POLLUTION_EMISSION = 1.0  # Emitted per factory per second
+POLLUTION_DIFFUSION = 0.2  # Share exchanged with each neighbouring cell per step (max 0.25)
+POLLUTION_DECAY = 0.05  # Fraction lost per second
+FARM_POLLUTION_PENALTY = 0.05  # Farm output lost per unit of local pollution
+HOUSE_POLLUTION_PENALTY = 0.05  # House capacity lost per unit of local pollution
+MAX_POLLUTION_PENALTY = 0.8
+
+# Commute settings
+WORKPLACES = (FACTORY, FARM, MINE)
+MAX_COMMUTE = 12  # Furthest a worker will travel, in tiles
+RAIL_COMMUTE_FACTOR = 0.25  # Commutes between rail-linked buildings count at a quarter of the distance
+WORKER_BUCKET = 8  # Tiles per side of a spatial index bucket
+
+# Data overlays, cycled with O. Each layer holds an index into its
+# (color, legend label) list per tile; entry 0 is transparent, so its
+# color (BLACK) must not be used by any other entry.
+OVERLAY_ALPHA = 150  # Opacity of an overlay over the map, 0-255
+POLLUTION_OVERLAY_LEVELS = 8
+POLLUTION_OVERLAY_MAX = MAX_POLLUTION_PENALTY / FARM_POLLUTION_PENALTY  # Pollution where penalties stop growing
+OVERLAYS = {  # name -> (title, entries)
+    "pollution": ("Pollution", [(BLACK, None)] + [
+        ((255, 230 - 25 * i, 60 - 7 * i),
+         "Light" if i == 0 else "Heavy" if i == POLLUTION_OVERLAY_LEVELS - 1 else None)
+        for i in range(POLLUTION_OVERLAY_LEVELS)]),
+    "rail": ("Rail bonus", [(BLACK, None), ((0, 200, 255), "Network"), ((255, 140, 0), "Cut-off track"),
+                            (GREEN, "Gets rail bonus"), (RED, "No rail bonus")]),
+    "workers": ("Workers", [(BLACK, None), ((150, 210, 255), "Spare workers in reach"), (GREEN, "Staffed"),
+                            (RED, "Unstaffed"), (BLUE, "House, all employed"), ((0, 220, 220), "House, spare workers")])
+}
+OVERLAY_PALETTES = {name: np.array([color for color, _ in entries], dtype=np.uint8)
+                    for name, (_, entries) in OVERLAYS.items()}
+
+# Minimap settings. Each minimap pixel covers a square block of tiles.
+MINIMAP_MAX_SIZE = 160  # Longest minimap side, in pixels
+MINIMAP_STEP = max(1, -(-max(GRID_WIDTH, GRID_HEIGHT) // MINIMAP_MAX_SIZE))  # Tiles per pixel
+MINIMAP_WIDTH = GRID_WIDTH // MINIMAP_STEP
+MINIMAP_HEIGHT = GRID_HEIGHT // MINIMAP_STEP
+MINIMAP_X = WIDTH - MINIMAP_WIDTH - 10
+MINIMAP_Y = 10
+MINIMAP_PALETTE = np.array([GREEN] + BUILDING_COLORS[1:], dtype=np.uint8)  # Type code -> color
+
+# Autosave settings
+AUTOSAVE_DIR = "saves"
+AUTOSAVE_INTERVAL = 60000  # Milliseconds between autosaves
+AUTOSAVE_SLOTS = 3  # Rotating save files, so a bad save never replaces the only good one
+SAVE_CHUNK = 2048  # Buildings converted between yields to the main thread
+
+# Terrain settings. Terrain is generated a chunk at a time, the first time
+# a chunk is drawn or queried, and cached on disk per seed.
+TERRAIN_DIR = "terrain"
+TERRAIN_VERSION = 1  # Bump when generation changes, so old caches are ignored
+TERRAIN_CHUNK = 32  # Tiles per chunk side
+GRASS, WATER, HILLS = 0, 1, 2
+TERRAIN_COLORS = np.array([GREEN, (60, 120, 200), (140, 150, 90)], dtype=np.float32)
+ORE_COLOR = np.array((120, 70, 40), dtype=np.float32)
+FERTILE_COLOR = np.array((20, 120, 20), dtype=np.float32)
+WATER_LEVEL = 0.34  # Elevation below this is water
+HILL_LEVEL = 0.64  # Elevation above this is hills
+START_CLEARING = 12  # Radius, in tiles, of the flat grass around the starting town
+DEPOSIT_FLOOR = 0.25  # Share of normal output from a mine or farm on barren ground
+DEPOSIT_PEAK = 1.75  # Share of normal output on the richest deposits
+TERRAIN_SURFACE_CACHE = 64  # Scaled chunk surfaces kept for drawing
+
+# Production cycle length per building type, in milliseconds. Each building
+# runs its own cycle, phased from the moment it was placed.
+PRODUCTION_PERIODS = {FACTORY: 5000, FARM: 10000, MINE: 10000}
+PRODUCTION_BASE_YIELDS = {FACTORY: 10, FARM: 20, MINE: 20}  # Base value for the rail bonus, before tech
+
+# Districts: production away from the view is simulated in aggregate
+DISTRICT_SIZE = TERRAIN_CHUNK  # Tiles per district side
+DISTRICT_TICK = 250  # Milliseconds between coarse district payouts and level checks
+DISTRICT_VIEW_MARGIN = 8  # Tiles around the view whose districts stay detailed
+DISTRICT_EDIT_HOLD = 30000  # Milliseconds a district stays detailed after an edit
+
+# Undo history settings. Commands store small deltas; these are rough size
+# estimates used to keep the whole history inside its memory budget.
+HISTORY_BUDGET = 2 * 1024 * 1024  # Bytes
+COMMAND_BYTES = 128
+PLACEMENT_BYTES = 64  # Per placed tile, not counting the building itself
+
+# Metrics recorder and graph settings
+METRIC_NAMES = ["resources", "pollution", "available_workers", "total_workers",
+                "buildings", "step_ms", "frame_ms"]
+RECORDER_CAPACITY = 36000  # Samples kept, one per simulation step (10 minutes)
+EXPORT_DIR = "exports"
+GRAPH_WIDTH = 200
+GRAPH_HEIGHT = 60
+GRAPH_SAMPLES_PER_COLUMN = 30  # Steps averaged into one graph column
+GRAPHS = [  # (metric, label, color)
+    ("resources", "Resources", YELLOW),
+    ("pollution", "Pollution", DARK_BROWN),
+    ("available_workers", "Idle workers", BLUE),
+    ("frame_ms", "Frame ms", RED)
+]
+
+# Simulation thread settings
+SIM_TICK = 1000 / 60  # Milliseconds per simulation step, the old frame rate
+
+# Idle frame pacing
+IDLE_AFTER = 3000  # Milliseconds without input before the window slows down
+IDLE_FPS = 4  # Redraws per second while idle
+
+# Multiplayer settings
+NET_PORT = 8765
+NET_BATCH = 6  # Simulation steps per broadcast (10 per second)
+NET_COMPRESS_OVER = 512  # Messages longer than this many bytes are zlib-compressed
+NET_HEADER = struct.Struct(">IB")  # Payload length, compressed flag
+NET_COMMANDS = {  # CityBuilder methods clients may call on the server -> argument types
+    "add_building_to_grid": (int, int, str),
+    "demolish_at": (int, int),
+    "research_technology": (int,),
+    "begin_command": (bool,),
+    "end_command": (),
+    "undo": (),
+    "redo": ()
+}
+
+# Globals changed by research, stored with saves
+TUNING_NAMES = [
+    "WORKERS_PER_FACTORY", "WORKERS_PER_FARM", "WORKERS_PER_MINE",
+    "FACTORY_PRODUCTION", "FARM_PRODUCTION", "MINE_PRODUCTION", "HOUSE_CAPACITY"
+]
+
 # Technology effect functions
 def reduce_factory_workers():
     global WORKERS_PER_FACTORY
@@ -145,78 +314,715 @@ except FileNotFoundError:
     BUILD_SOUND = None
     RESOURCE_SOUND = None
 
-class CityBuilder:
+# Everything the renderer needs for one frame. Published by the simulation
+# thread and never modified afterwards, so the render loop can read it freely.
+FrameState = namedtuple("FrameState", [
+    "buildings",  # (code, x, y, active, is_vertical) per building
+    "smoke",  # (x, y, alpha) per particle
+    "resources", "pollution", "available_workers", "total_workers",
+    "researched", "costs", "tuning",
+    "overlay",  # (name, inputs key, layer array) of the overlay shown, or None
+    "grid",  # Copy of the type grid, replaced (never written) when occupancy changes
+    "occupied_version"  # occupied_version the grid copy was taken at
+])
+
+class FrameBuffer:
+    # Double buffer: the simulation fills the back slot, then flips which
+    # slot is the front. Readers only ever see a complete frame.
     def __init__(self):
+        self.slots = [None, None]
+        self.front = 0
+        self.lock = threading.Lock()
+
+    def publish(self, frame):
+        back = 1 - self.front
+        self.slots[back] = frame
+        with self.lock:
+            self.front = back
+
+    def read(self):
+        with self.lock:
+            return self.slots[self.front]
+
+class MetricsRecorder:
+    # Fixed-size ring buffer of samples. count is the total ever recorded;
+    # sample i lives in row i % capacity until it is overwritten.
+    def __init__(self, names, capacity=RECORDER_CAPACITY):
+        self.names = names
+        self.columns = {name: i for i, name in enumerate(names)}
+        self.capacity = capacity
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.data = np.zeros((capacity, len(names)), dtype=np.float32)
+        self.count = 0
+
+    def record(self, time_ms, values):
+        row = self.count % self.capacity
+        self.times[row] = time_ms
+        self.data[row] = values
+        self.count += 1  # Bumped last, so readers never see a half-written row
+
+    def first(self):
+        return max(0, self.count - self.capacity)
+
+    def values(self, name, start, end):
+        # Samples start..end-1 of one metric, oldest first
+        rows = np.arange(start, end) % self.capacity
+        return self.data[rows, self.columns[name]]
+
+    def ordered(self):
+        rows = np.arange(self.first(), self.count) % self.capacity
+        return self.times[rows], self.data[rows]
+
+    def export(self, path):
+        # Copy now, write in the background so the game keeps running
+        times, data = self.ordered()
+        threading.Thread(target=write_metrics, args=(times, data, self.names, path), daemon=True).start()
+
+class GraphPanel:
+    # One metric drawn as a scrolling line graph. New columns are added by
+    # scrolling the existing surface left; a full redraw only happens when
+    # the values outgrow the scale or the panel falls too far behind.
+    def __init__(self, recorder, metric, label, color, font):
+        self.recorder = recorder
+        self.metric = metric
+        self.label = label
+        self.color = color
+        self.font = font
+        self.surface = pygame.Surface((GRAPH_WIDTH, GRAPH_HEIGHT))
+        self.surface.fill(WHITE)
+        self.scale = 1.0
+        self.drawn = 0  # Samples already turned into columns
+        self.last_y = None
+        self.last_value = 0.0
+
+    def column_y(self, value):
+        return GRAPH_HEIGHT - 1 - int(max(0.0, value) / self.scale * (GRAPH_HEIGHT - 1))
+
+    def column_values(self, start, columns):
+        samples = self.recorder.values(self.metric, start, start + columns * GRAPH_SAMPLES_PER_COLUMN)
+        return samples.reshape(columns, GRAPH_SAMPLES_PER_COLUMN).mean(axis=1)
+
+    def redraw(self):
+        columns = min(GRAPH_WIDTH, (self.recorder.count - self.recorder.first()) // GRAPH_SAMPLES_PER_COLUMN)
+        self.drawn = self.recorder.count - (self.recorder.count - self.recorder.first()) % GRAPH_SAMPLES_PER_COLUMN
+        self.surface.fill(WHITE)
+        self.last_y = None
+        if columns == 0:
+            return
+        values = self.column_values(self.drawn - columns * GRAPH_SAMPLES_PER_COLUMN, columns)
+        while values.max() > self.scale:
+            self.scale *= 2
+        for i, value in enumerate(values):
+            self.draw_column(GRAPH_WIDTH - columns + i, value)
+
+    def draw_column(self, x, value):
+        y = self.column_y(value)
+        pygame.draw.line(self.surface, self.color, (x, self.last_y if self.last_y is not None else y), (x, y))
+        self.last_y = y
+        self.last_value = float(value)
+
+    def update(self):
+        columns = (self.recorder.count - self.drawn) // GRAPH_SAMPLES_PER_COLUMN
+        if columns <= 0:
+            return
+        if columns > GRAPH_WIDTH or self.drawn < self.recorder.first():
+            self.redraw()
+            return
+        for value in self.column_values(self.drawn, columns):
+            self.drawn += GRAPH_SAMPLES_PER_COLUMN
+            if value > self.scale:
+                self.redraw()
+                return
+            self.surface.scroll(-1, 0)
+            pygame.draw.line(self.surface, WHITE, (GRAPH_WIDTH - 1, 0), (GRAPH_WIDTH - 1, GRAPH_HEIGHT))
+            self.draw_column(GRAPH_WIDTH - 1, value)
+
+    def draw(self, screen, x, y):
+        self.update()
+        screen.blit(self.surface, (x, y))
+        pygame.draw.rect(screen, BLACK, (x - 1, y - 1, GRAPH_WIDTH + 2, GRAPH_HEIGHT + 2), 1)
+        text = self.font.render(f"{self.label}: {self.last_value:.1f}", True, BLACK)
+        screen.blit(text, (x + 3, y + 2))
+
+class ScheduledEvent:
+    __slots__ = ("time", "order", "action", "args", "pending")
+
+    def __init__(self, time, order, action, args):
+        self.time = time
+        self.order = order  # Tie-breaker: equal times run in scheduling order
+        self.action = action
+        self.args = args
+        self.pending = True
+
+    def __lt__(self, other):
+        return (self.time, self.order) < (other.time, other.order)
+
+class EventScheduler:
+    # Binary heap of timed simulation events. Cancelling only marks an event
+    # dead (O(1)); dead events are dropped when they reach the top, and the
+    # heap is rebuilt if they ever make up most of it.
+    def __init__(self):
+        self.heap = []
+        self.order = 0
+        self.cancelled = 0
+
+    def schedule(self, time, action, *args):
+        event = ScheduledEvent(time, self.order, action, args)
+        self.order += 1
+        heapq.heappush(self.heap, event)
+        return event
+
+    def cancel(self, event):
+        if event.pending:
+            event.pending = False
+            self.cancelled += 1
+            if self.cancelled > 64 and self.cancelled > len(self.heap) // 2:
+                self.heap = [e for e in self.heap if e.pending]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+
+    def reschedule(self, event, time):
+        self.cancel(event)
+        return self.schedule(time, event.action, *event.args)
+
+    def next_time(self):
+        while self.heap and not self.heap[0].pending:
+            heapq.heappop(self.heap)
+            self.cancelled -= 1
+        return self.heap[0].time if self.heap else None
+
+    def run_due(self, now):
+        # Run every event due by now, in time order. Events scheduled by
+        # these actions for now or earlier also run in this call.
+        ran = 0
+        while self.heap and self.heap[0].time <= now:
+            event = heapq.heappop(self.heap)
+            if not event.pending:
+                self.cancelled -= 1
+                continue
+            event.pending = False
+            event.action(*event.args)
+            ran += 1
+        return ran
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+class PlaceCommand:
+    # One or more placements (a single click, or a whole track drag). Each
+    # entry keeps the building plus what was paid and how much its type's
+    # cost went up, which is all that's needed to reverse it.
+    def __init__(self):
+        self.placements = []  # (building, paid, cost_increase)
+
+    def __len__(self):
+        return len(self.placements)
+
+    def size(self):
+        return COMMAND_BYTES + PLACEMENT_BYTES * len(self.placements)
+
+    def undo(self, game):
+        for building, paid, cost_increase in reversed(self.placements):
+            game.remove_building(building)
+            game.resources += paid
+            BUILDINGS[building.type]["current_cost"] -= cost_increase
+        return True
+
+    def redo(self, game):
+        for building, _, _ in self.placements:
+            if not game.is_space_available(building.grid_x, building.grid_y, building.type):
+                return False
+        if game.resources < sum(paid for _, paid, _ in self.placements):
+            return False
+        self.placements = [(building,) + game.place_building(building) for building, _, _ in self.placements]
+        return True
+
+class DemolishCommand:
+    # Buildings taken down by the bulldozer (one click or a drag), in
+    # removal order. Demolition is free and refunds nothing.
+    def __init__(self):
+        self.removals = []
+
+    def __len__(self):
+        return len(self.removals)
+
+    def size(self):
+        return COMMAND_BYTES + PLACEMENT_BYTES * len(self.removals)
+
+    def undo(self, game):
+        for building in self.removals:
+            if not game.is_space_available(building.grid_x, building.grid_y, building.type):
+                return False
+        for building in reversed(self.removals):
+            game.restore_building(building)
+        return True
+
+    def redo(self, game):
+        for building in self.removals:
+            game.remove_building(building)
+        return True
+
+class ResearchCommand:
+    # A researched technology, with the tuning globals it changed
+    def __init__(self, tech_key, paid, tuning_before, tuning_after):
+        self.tech_key = tech_key
+        self.paid = paid
+        self.tuning_before = tuning_before
+        self.tuning_after = tuning_after
+
+    def size(self):
+        return COMMAND_BYTES
+
+    def undo(self, game):
+        game.settle_districts(stale=True)
+        globals().update(self.tuning_before)
+        game.researched_technologies.discard(self.tech_key)
+        game.resources += self.paid
+        game.assign_workers()
+        return True
+
+    def redo(self, game):
+        if game.resources < self.paid:
+            return False
+        game.resources -= self.paid
+        game.settle_districts(stale=True)
+        globals().update(self.tuning_after)
+        game.researched_technologies.add(self.tech_key)
+        game.assign_workers()
+        return True
+
+class CommandHistory:
+    # Undo and redo stacks, trimmed from the oldest end to stay in budget
+    def __init__(self, budget=HISTORY_BUDGET):
+        self.budget = budget
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.size = 0
+
+    def push(self, command):
+        for old in self.redo_stack:
+            self.size -= old.size()
+        self.redo_stack = []
+        self.undo_stack.append(command)
+        self.size += command.size()
+        while self.size > self.budget and len(self.undo_stack) > 1:
+            self.size -= self.undo_stack.popleft().size()
+
+    def undo(self, game):
+        if self.undo_stack and self.undo_stack[-1].undo(game):
+            self.redo_stack.append(self.undo_stack.pop())
+
+    def redo(self, game):
+        if self.redo_stack and self.redo_stack[-1].redo(game):
+            self.undo_stack.append(self.redo_stack.pop())
+
+class Building:
+    # Slots keep per-building memory small for cities with 100k+ buildings
+    __slots__ = ("code", "x", "y", "grid_x", "grid_y", "active",
+                 "capacity", "employed", "jobs", "crew", "production")
+
+    def __init__(self, code, grid_x, grid_y, active=False):
+        self.code = code
+        self.x = grid_x * GRID_SIZE
+        self.y = grid_y * GRID_SIZE
+        self.grid_x = grid_x
+        self.grid_y = grid_y
+        self.active = active
+        self.capacity = 0  # Houses: workers living here
+        self.employed = 0  # Houses: workers with a job
+        self.jobs = None  # Houses: workplace -> workers sent there
+        self.crew = None  # Workplaces: house -> workers hired from it
+        self.production = None  # Workplaces: next scheduled production event
+
+    @property
+    def type(self):
+        return BUILDING_TYPES[self.code]
+
+class District:
+    # The workplaces in one DISTRICT_SIZE block of the map. Near the view, or
+    # after an edit, each runs its own production event. Otherwise the
+    # district is coarse: due times live in arrays and are paid in bulk.
+    __slots__ = ("workplaces", "coarse", "last_edit", "due", "periods", "next_due",
+                 "yields", "stale", "farms", "farm_cells", "farm_weights")
+
+    def __init__(self):
+        self.workplaces = []
+        self.coarse = False
+        self.last_edit = -DISTRICT_EDIT_HOLD
+        self.due = None  # Coarse: next due time per workplace
+        self.periods = None
+        self.next_due = None  # Coarse: earliest of due
+        self.yields = None  # Coarse: per-cycle output before farm pollution, 0 while idle
+        self.stale = True  # yields need recomputing
+        self.farms = None  # Coarse: indices of farms, with the pollution cells they average
+        self.farm_cells = None
+        self.farm_weights = None
+
+def lattice_noise(i, j, seed):
+    # Integer hash of lattice points to [0, 1), vectorized over arrays
+    h = (i.astype(np.uint64) * np.uint64(374761393) + j.astype(np.uint64) * np.uint64(668265263) +
+         np.uint64(seed * 2654435761 % 2**32)) & np.uint64(0xFFFFFFFF)
+    h = ((h ^ (h >> np.uint64(13))) * np.uint64(1274126177)) & np.uint64(0xFFFFFFFF)
+    h ^= h >> np.uint64(16)
+    return h.astype(np.float32) / np.float32(2**32)
+
+def value_noise(x, y, seed, scale):
+    # Smoothly interpolated lattice noise; x, y are world tile coordinates,
+    # so neighbouring chunks line up without seams
+    fx, fy = x / scale, y / scale
+    ix, iy = np.floor(fx).astype(np.int64), np.floor(fy).astype(np.int64)
+    tx, ty = fx - ix, fy - iy
+    tx, ty = tx * tx * (3 - 2 * tx), ty * ty * (3 - 2 * ty)
+    top = lattice_noise(ix, iy, seed) * (1 - tx) + lattice_noise(ix + 1, iy, seed) * tx
+    bottom = lattice_noise(ix, iy + 1, seed) * (1 - tx) + lattice_noise(ix + 1, iy + 1, seed) * tx
+    return top * (1 - ty) + bottom * ty
+
+def fractal_noise(x, y, seed, scale, octaves):
+    total = np.zeros(x.shape, dtype=np.float32)
+    amplitude, weight = 1.0, 0.0
+    for octave in range(octaves):
+        total += amplitude * value_noise(x, y, seed + octave * 7919, scale / 2 ** octave)
+        weight += amplitude
+        amplitude /= 2
+    return total / weight
+
+def summed_area(occupied):
+    # table[x, y] counts the True entries of occupied[:x, :y]
+    table = np.zeros((occupied.shape[0] + 1, occupied.shape[1] + 1), dtype=np.int32)
+    table[1:, 1:] = occupied.cumsum(axis=0).cumsum(axis=1)
+    return table
+
+def anchor_mask(table, grid_w, grid_h):
+    # Top-left tiles of every free grid_w x grid_h footprint, from four
+    # shifted views of a summed-area table
+    counts = (table[grid_w:, grid_h:] - table[:-grid_w, grid_h:]
+              - table[grid_w:, :-grid_h] + table[:-grid_w, :-grid_h])
+    return counts == 0
+
+class Terrain:
+    # Seeded terrain: a kind per tile (grass, water, hills) plus ore and
+    # fertility in 0..1. Chunks are made on first use, from memory, the
+    # disk cache or the noise functions, in that order. Only the
+    # simulation thread makes chunks; the render thread reads with
+    # generate=False and sees bare grass where a chunk isn't ready yet.
+    def __init__(self, seed, cache_dir=TERRAIN_DIR):
+        self.seed = seed
+        self.cache_dir = cache_dir and os.path.join(cache_dir, f"v{TERRAIN_VERSION}-{seed}")
+        self.chunks = {}  # (chunk_x, chunk_y) -> {"kind", "ore", "fertility", "colors"}, never changed once added
+        self.surfaces = {}  # (chunk_x, chunk_y, tile_size) -> scaled Surface, render thread only
+        blank = {"kind": np.full((TERRAIN_CHUNK, TERRAIN_CHUNK), GRASS, dtype=np.int8),
+                 "ore": np.zeros((TERRAIN_CHUNK, TERRAIN_CHUNK), dtype=np.float32),
+                 "fertility": np.zeros((TERRAIN_CHUNK, TERRAIN_CHUNK), dtype=np.float32)}
+        blank["colors"] = self.chunk_colors(blank)
+        self.blank = blank  # Stand-in for chunks not generated yet
+
+    def chunk(self, chunk_x, chunk_y, generate=True):
+        chunk = self.chunks.get((chunk_x, chunk_y))
+        if chunk is None:
+            if not generate:
+                return self.blank
+            chunk = self.load_chunk(chunk_x, chunk_y)
+            if chunk is None:
+                chunk = self.generate_chunk(chunk_x, chunk_y)
+                self.save_chunk(chunk_x, chunk_y, chunk)
+            chunk["colors"] = self.chunk_colors(chunk)
+            self.chunks[(chunk_x, chunk_y)] = chunk  # Added complete, so readers never see half a chunk
+        return chunk
+
+    def chunk_path(self, chunk_x, chunk_y):
+        return os.path.join(self.cache_dir, f"{chunk_x}_{chunk_y}.npz")
+
+    def load_chunk(self, chunk_x, chunk_y):
+        if not self.cache_dir:
+            return None
+        try:
+            with np.load(self.chunk_path(chunk_x, chunk_y)) as data:
+                return {name: data[name] for name in ("kind", "ore", "fertility")}
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save_chunk(self, chunk_x, chunk_y, chunk):
+        # Written to a temporary file and renamed, like autosaves, so a
+        # reader never sees half a chunk. The name is unique per process and
+        # thread, since parallel cities share the cache. Failing to cache
+        # isn't fatal.
+        if not self.cache_dir:
+            return
+        path = self.chunk_path(chunk_x, chunk_y)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.savez(temp_path, **chunk)
+            os.replace(temp_path, path)
+        except OSError:
+            pass
+
+    def generate_chunk(self, chunk_x, chunk_y):
+        xs = np.arange(chunk_x * TERRAIN_CHUNK, (chunk_x + 1) * TERRAIN_CHUNK, dtype=np.float32)
+        ys = np.arange(chunk_y * TERRAIN_CHUNK, (chunk_y + 1) * TERRAIN_CHUNK, dtype=np.float32)
+        x, y = np.meshgrid(xs, ys, indexing="ij")  # Indexed [x, y] like the grid
+        elevation = fractal_noise(x, y, self.seed, 48, 4)
+        # Level the ground around the map centre into plain grass for the starting town
+        distance = np.hypot(x - GRID_WIDTH / 2, y - GRID_HEIGHT / 2)
+        elevation += (0.5 - elevation) * np.clip(1.5 - distance / START_CLEARING, 0, 1)
+
+        kind = np.full(x.shape, GRASS, dtype=np.int8)
+        kind[elevation < WATER_LEVEL] = WATER
+        kind[elevation > HILL_LEVEL] = HILLS
+        # Ore gathers in the hills, fertile soil in the lowlands
+        ore = np.clip((fractal_noise(x, y, self.seed + 1, 12, 3) - 0.5) * 3 + (elevation - 0.5) * 2, 0, 1)
+        fertility = np.clip((fractal_noise(x, y, self.seed + 2, 20, 3) - 0.4) * 2.5 + (0.55 - elevation), 0, 1)
+        ore[kind == WATER] = 0
+        fertility[kind == WATER] = 0
+        return {"kind": kind, "ore": ore.astype(np.float32), "fertility": fertility.astype(np.float32)}
+
+    def chunk_colors(self, chunk):
+        colors = TERRAIN_COLORS[chunk["kind"]]
+        ore = chunk["ore"][..., None] * 0.7
+        fertility = chunk["fertility"][..., None] * 0.5
+        colors = colors * (1 - ore) + ORE_COLOR * ore
+        colors = colors * (1 - fertility) + FERTILE_COLOR * fertility
+        return colors.astype(np.uint8)
+
+    def region(self, layer, grid_x, grid_y, grid_w, grid_h, generate=True):
+        # One layer for a rectangle of tiles, copied from every chunk it overlaps
+        first = self.chunk(grid_x // TERRAIN_CHUNK, grid_y // TERRAIN_CHUNK, generate)[layer]
+        out = np.empty((grid_w, grid_h) + first.shape[2:], dtype=first.dtype)
+        for chunk_x in range(grid_x // TERRAIN_CHUNK, (grid_x + grid_w - 1) // TERRAIN_CHUNK + 1):
+            for chunk_y in range(grid_y // TERRAIN_CHUNK, (grid_y + grid_h - 1) // TERRAIN_CHUNK + 1):
+                data = self.chunk(chunk_x, chunk_y, generate)[layer]
+                x0 = max(grid_x, chunk_x * TERRAIN_CHUNK)
+                y0 = max(grid_y, chunk_y * TERRAIN_CHUNK)
+                x1 = min(grid_x + grid_w, (chunk_x + 1) * TERRAIN_CHUNK)
+                y1 = min(grid_y + grid_h, (chunk_y + 1) * TERRAIN_CHUNK)
+                out[x0 - grid_x:x1 - grid_x, y0 - grid_y:y1 - grid_y] = \
+                    data[x0 - chunk_x * TERRAIN_CHUNK:x1 - chunk_x * TERRAIN_CHUNK,
+                         y0 - chunk_y * TERRAIN_CHUNK:y1 - chunk_y * TERRAIN_CHUNK]
+        return out
+
+    def is_dry(self, grid_x, grid_y, grid_w, grid_h, generate=True):
+        # Footprints are a few tiles, so direct lookups beat building a region
+        for x in range(grid_x, grid_x + grid_w):
+            for y in range(grid_y, grid_y + grid_h):
+                kind = self.chunk(x // TERRAIN_CHUNK, y // TERRAIN_CHUNK, generate)["kind"]
+                if kind[x % TERRAIN_CHUNK, y % TERRAIN_CHUNK] == WATER:
+                    return False
+        return True
+
+    def dry_anchors(self, building_type, grid_x, grid_y, width, height, generate=True):
+        # Mask of anchors in a rectangle whose footprint has no water
+        grid_w, grid_h = BUILDINGS[building_type]["grid_size"]
+        water = self.region("kind", grid_x, grid_y, width + grid_w - 1, height + grid_h - 1, generate) == WATER
+        dry = np.ones((width, height), dtype=bool)
+        for i in range(grid_w):
+            for j in range(grid_h):
+                dry &= ~water[i:i + width, j:j + height]
+        return dry
+
+    def richness(self, building):
+        # Mean ore under a mine, or fertility under a farm
+        grid_w, grid_h = BUILDING_SIZES[building.code]
+        layer = "ore" if building.code == MINE else "fertility"
+        return float(self.region(layer, building.grid_x, building.grid_y, grid_w, grid_h).mean())
+
+    def surface(self, chunk_x, chunk_y, tile_size):
+        # Render thread: a chunk that isn't generated yet draws as blank
+        # grass and isn't cached, so it shows properly once it's ready
+        key = (chunk_x, chunk_y, tile_size)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            if (chunk_x, chunk_y) not in self.chunks:
+                pixels = pygame.surfarray.make_surface(self.blank["colors"])
+                return pygame.transform.scale(pixels, (TERRAIN_CHUNK * tile_size, TERRAIN_CHUNK * tile_size))
+            if len(self.surfaces) >= TERRAIN_SURFACE_CACHE:
+                self.surfaces.pop(next(iter(self.surfaces)))  # Oldest first
+            pixels = pygame.surfarray.make_surface(self.chunk(chunk_x, chunk_y)["colors"])
+            surface = pygame.transform.scale(pixels, (TERRAIN_CHUNK * tile_size, TERRAIN_CHUNK * tile_size))
+            self.surfaces[key] = surface
+        return surface
+
+class CityBuilder:
+    def __init__(self, clock=pygame.time.get_ticks, autosave=True, seed=0):
+        self.get_ticks = clock  # Milliseconds; a simulated clock when running headless
+        self.autosave_enabled = autosave
+        self.terrain = Terrain(seed)
         self.resources = 475
         self.pollution = 0
         self.buildings = []
-        self.grid = [[False for _ in range(GRID_HEIGHT)] for _ in range(GRID_WIDTH)]
+        self.grid = np.zeros((GRID_WIDTH, GRID_HEIGHT), dtype=np.int8)  # Type code per tile
+        self.occupied_version = 0  # Bumped on every change to grid, for cached copies and masks
+        self.minimap_pixels = np.empty((MINIMAP_WIDTH, MINIMAP_HEIGHT, 3), dtype=np.uint8)
+        self.minimap_row_versions = np.zeros(MINIMAP_HEIGHT, dtype=np.int64)  # Bumped when a row changes
+        self.update_minimap_rows(0, GRID_HEIGHT)
+        self.type_counts = [0] * len(BUILDING_TYPES)
+        self.pollution_field = np.zeros((POLLUTION_WIDTH, POLLUTION_HEIGHT), dtype=np.float32)
+        self.emission_field = np.zeros((POLLUTION_WIDTH, POLLUTION_HEIGHT), dtype=np.float32)
+        self.pollution_scratch = np.zeros((POLLUTION_WIDTH, POLLUTION_HEIGHT), dtype=np.float32)
         self.current_building = "house"
         self.font = pygame.font.Font(None, 36)
         self.tech_font = pygame.font.Font(None, 24)
-        self.last_pollution_time = pygame.time.get_ticks()
-        self.last_factory_production = pygame.time.get_ticks()
-        self.last_mine_production = pygame.time.get_ticks()
-        self.last_farm_production = pygame.time.get_ticks()
+        self.last_pollution_time = self.get_ticks()
+        self.scheduler = EventScheduler()
+        self.last_production_time = self.get_ticks()  # Time of the last produce_resources step
+        self.districts = {}  # (district_x, district_y) -> District
+        self.last_district_time = self.get_ticks()
+        self.produced = False  # Whether anything paid out this step, for the sound
+        self.history = CommandHistory()
+        self.open_command = None  # Collects placements while a track drag is in progress
+        self.recorder = MetricsRecorder(METRIC_NAMES)
+        # Change journal for the multiplayer server; None unless serving
+        self.journal = None  # Placements and removals, in order
+        self.activity_changes = None  # Building -> latest active flag
+        self.buildings_at = {}  # (grid_x, grid_y) -> building, kept by multiplayer clients
+        self.frame_ms = 0.0  # Written by the render loop, sampled by the simulation
+        self.overlay = None  # Overlay shown, written by the render loop; its layer is built here
+        self.overlay_layers = {}  # Overlay name -> (inputs key, layer)
+        self.worker_version = 0  # Bumped whenever staffing or house capacities change
         self.unlocked_buildings = {"house", "farm", "mine", "factory", "railroad"}
         self.researched_technologies = set()
         self.tech_menu_open = False
+
+        # Render-side state: only touched by the input/render loop
+        self.zoom = 0  # Index into ZOOM_TILE_SIZES
+        self.tile_size = GRID_SIZE  # Screen pixels per tile at the current zoom
+        self.sprites = {}  # (code, active, is_vertical, tile_size) -> scaled building sprite
+        self.tile_pixels = None  # One pixel per visible tile at far zoom
+        self.tile_surface = None  # tile_pixels scaled to the screen
+        self.idle_ms = 0  # How long the window has been idle, 0 while in use
+        self.preview_mode = False  # Ghost footprint under the cursor and valid anchors
+        self.valid_anchor_cache = (None, None)  # (type, view tile, frame occupied version, chunks ready), overlay
+        self.minimap_surface = pygame.Surface((MINIMAP_WIDTH, MINIMAP_HEIGHT))
+        self.overlay_map = (None, None)  # (name, inputs key), layer colored at one pixel per tile
+        self.overlay_view = (None, None)  # (map key, view tile, tile size), overlay_map scaled for the view
+        self.minimap_rows_drawn = np.full(MINIMAP_HEIGHT, -1, dtype=np.int64)
+        self.graphs_open = False
+        self.graphs = [GraphPanel(self.recorder, metric, label, color, self.tech_font)
+                       for metric, label, color in GRAPHS]
         self.smoke_particles = []  # For factory smoke animation
-        self.last_smoke_time = pygame.time.get_ticks()
+        self.last_smoke_time = self.get_ticks()
+        self.last_autosave_time = self.get_ticks()
+        self.autosave_thread = None
+        self.autosave_slot = 0
+        self.commands = queue.SimpleQueue()  # Input actions waiting for the simulation thread
+        self.wake = threading.Event()  # Set by post() so an idle simulation thread wakes at once
+        self.next_wake = None  # get_ticks time the simulation next has work due, set each step
+        self.frames = FrameBuffer()
+        self.buildings_changed = True  # Building render list needs rebuilding
+        self.building_frame = ()
+        self.grid_frame = (-1, None)  # (occupied_version, grid copy) last published
+
+        # Spatial index for commute matching: bucket -> buildings
+        self.house_buckets = {}
+        self.workplace_buckets = {}
+        self.houses_by_cell = {}  # Pollution cell -> houses, for capacity updates
+        self.unstaffed = {}  # Workplaces still waiting for a crew (ordered set)
+        self.house_capacity_field = np.zeros((POLLUTION_WIDTH, POLLUTION_HEIGHT), dtype=np.int32)
+
+        # Rail connectivity, kept up to date as track is laid and removed.
+        # The network is the component holding rail_root, the oldest tile.
+        self.rail_tiles = {}  # (grid_x, grid_y) -> railroad building
+        self.rail_labels = {}  # (grid_x, grid_y) -> component label
+        self.rail_components = {}  # Label -> set of tiles
+        self.next_rail_label = 0
+        self.rail_root = None
 
         # Starting buildings
-        center_x, center_y = GRID_WIDTH // 2 - 1, GRID_HEIGHT // 2  # (19, 15)
-        farm_x, farm_y = center_x + 4, center_y - 1  # (23, 14)
-        pixel_x = farm_x * GRID_SIZE
-        pixel_y = farm_y * GRID_SIZE
-        self.buildings.append({
-            "type": "farm",
-            "x": pixel_x,
-            "y": pixel_y,
-            "grid_x": farm_x,
-            "grid_y": farm_y,
-            "active": False
-        })
-        self.occupy_grid(farm_x, farm_y, "farm")
+        center_x, center_y = GRID_WIDTH // 2 - 1, GRID_HEIGHT // 2  # (79, 60)
+        farm_x, farm_y = center_x + 4, center_y - 1  # (83, 59)
+        self.buildings.append(Building(FARM, farm_x, farm_y))
+        self.occupy_grid(farm_x, farm_y, FARM)
+        self.district_of(self.buildings[-1]).workplaces.append(self.buildings[-1])
+        self.schedule_production(self.buildings[-1], PRODUCTION_PERIODS[FARM])
         self.resources -= BUILDINGS["farm"]["base_cost"]  # Deduct $75
 
         house_positions = [
-            (center_x + 2, center_y - 1),  # (21, 14)
-            (center_x + 3, center_y - 1),  # (22, 14)
-            (center_x + 2, center_y),      # (21, 15)
-            (center_x + 3, center_y)       # (22, 15)
+            (center_x + 2, center_y - 1),  # (81, 59)
+            (center_x + 3, center_y - 1),  # (82, 59)
+            (center_x + 2, center_y),      # (81, 60)
+            (center_x + 3, center_y)       # (82, 60)
         ]
         for grid_x, grid_y in house_positions:
-            pixel_x = grid_x * GRID_SIZE
-            pixel_y = grid_y * GRID_SIZE
-            self.buildings.append({
-                "type": "house",
-                "x": pixel_x,
-                "y": pixel_y,
-                "grid_x": grid_x,
-                "grid_y": grid_y,
-                "active": True
-            })
-            self.occupy_grid(grid_x, grid_y, "house")
+            self.buildings.append(Building(HOUSE, grid_x, grid_y, active=True))
+            self.occupy_grid(grid_x, grid_y, HOUSE)
             self.resources -= BUILDINGS["house"]["base_cost"]  # Deduct $50 each
 
+        # Start with the camera framing the starting buildings
+        self.camera_x = (center_x + 1) * GRID_SIZE - WIDTH // 2
+        self.camera_y = center_y * GRID_SIZE - HEIGHT // 2
+
         self.assign_workers()
+        self.publish_frame()
 
     def is_space_available(self, grid_x, grid_y, building_type):
         grid_w, grid_h = BUILDINGS[building_type]["grid_size"]
-        if grid_x + grid_w > GRID_WIDTH or grid_y + grid_h > GRID_HEIGHT:
+        if grid_x < 0 or grid_y < 0 or grid_x + grid_w > GRID_WIDTH or grid_y + grid_h > GRID_HEIGHT:
             return False
-        for i in range(grid_w):
-            for j in range(grid_h):
-                if self.grid[grid_x + i][grid_y + j]:
-                    return False
-        return True
+        # A slice of the footprint: a few tiles, whatever the map size
+        if (self.grid[grid_x:grid_x + grid_w, grid_y:grid_y + grid_h] != EMPTY).any():
+            return False
+        return self.terrain.is_dry(grid_x, grid_y, grid_w, grid_h)
 
-    def occupy_grid(self, grid_x, grid_y, building_type):
-        grid_w, grid_h = BUILDINGS[building_type]["grid_size"]
+    def occupy_grid(self, grid_x, grid_y, code):
+        grid_w, grid_h = BUILDING_SIZES[code]
+        self.grid[grid_x:grid_x + grid_w, grid_y:grid_y + grid_h] = code
+        self.occupied_version += 1
+        self.type_counts[code] += 1
+        self.update_minimap_rows(grid_y, grid_y + grid_h)
+
+    def clear_grid(self, grid_x, grid_y, code):
+        grid_w, grid_h = BUILDING_SIZES[code]
+        self.grid[grid_x:grid_x + grid_w, grid_y:grid_y + grid_h] = EMPTY
+        self.occupied_version += 1
+        self.type_counts[code] -= 1
+        self.update_minimap_rows(grid_y, grid_y + grid_h)
+
+    def update_minimap_rows(self, grid_y0, grid_y1):
+        # Recolor only the minimap rows covering grid rows grid_y0..grid_y1.
+        # Each pixel shows the highest type code in its block of tiles.
+        row0 = grid_y0 // MINIMAP_STEP
+        row1 = min(MINIMAP_HEIGHT, -(-grid_y1 // MINIMAP_STEP))
+        if row1 <= row0:
+            return
+        tiles = self.grid[:MINIMAP_WIDTH * MINIMAP_STEP, row0 * MINIMAP_STEP:row1 * MINIMAP_STEP]
+        blocks = tiles.reshape(MINIMAP_WIDTH, MINIMAP_STEP, row1 - row0, MINIMAP_STEP).max(axis=(1, 3))
+        self.minimap_pixels[:, row0:row1] = MINIMAP_PALETTE[blocks]
+        self.minimap_row_versions[row0:row1] += 1
+
+    def add_emission_source(self, grid_x, grid_y, code, sign=1):
+        # Spread the building's emission over the pollution cells under its footprint
+        grid_w, grid_h = BUILDING_SIZES[code]
+        per_tile = sign * POLLUTION_EMISSION / (grid_w * grid_h)
         for i in range(grid_w):
             for j in range(grid_h):
-                self.grid[grid_x + i][grid_y + j] = True
+                cx = (grid_x + i) // POLLUTION_CELL
+                cy = (grid_y + j) // POLLUTION_CELL
+                self.emission_field[cx, cy] += per_tile
+
+    def pollution_span(self, building):
+        # Pollution cells x0:x1, y0:y1 under the building's footprint
+        grid_w, grid_h = BUILDING_SIZES[building.code]
+        x0 = building.grid_x // POLLUTION_CELL
+        y0 = building.grid_y // POLLUTION_CELL
+        x1 = (building.grid_x + grid_w - 1) // POLLUTION_CELL + 1
+        y1 = (building.grid_y + grid_h - 1) // POLLUTION_CELL + 1
+        return x0, y0, x1, y1
+
+    def local_pollution(self, building):
+        x0, y0, x1, y1 = self.pollution_span(building)
+        return float(self.pollution_field[x0:x1, y0:y1].mean())
+
+    def pollution_penalty(self, building, penalty_per_unit):
+        return min(MAX_POLLUTION_PENALTY, self.local_pollution(building) * penalty_per_unit)
+
+    def compute_house_capacities(self):
+        # Capacity of a (single tile) house in every pollution cell
+        penalty = np.minimum(MAX_POLLUTION_PENALTY, self.pollution_field * HOUSE_POLLUTION_PENALTY)
+        return np.rint(HOUSE_CAPACITY * (1 - penalty)).astype(np.int32)
+
+    def house_capacity(self, house):
+        cx = house.grid_x // POLLUTION_CELL
+        cy = house.grid_y // POLLUTION_CELL
+        return int(self.house_capacity_field[cx, cy])
 
     def add_building_to_grid(self, grid_x, grid_y, building_type):
         if building_type not in self.unlocked_buildings:
@@ -226,85 +1032,528 @@ class CityBuilder:
         if not self.is_space_available(grid_x, grid_y, building_type):
             return
         
-        pixel_x = grid_x * GRID_SIZE
-        pixel_y = grid_y * GRID_SIZE
-        self.buildings.append({
-            "type": building_type,
-            "x": pixel_x,
-            "y": pixel_y,
-            "grid_x": grid_x,
-            "grid_y": grid_y,
-            "active": False
-        })
-        self.occupy_grid(grid_x, grid_y, building_type)
-        self.resources -= BUILDINGS[building_type]["current_cost"]
+        building = Building(TYPE_CODES[building_type], grid_x, grid_y)
+        paid, cost_increase = self.place_building(building)
+        command = self.command_for(PlaceCommand)
+        command.placements.append((building, paid, cost_increase))
+        if command is not self.open_command:
+            self.history.push(command)
+
+    def place_building(self, building):
+        # Places an already validated building and returns (paid, cost increase)
+        code = building.code
+        building_type = BUILDING_TYPES[code]
+        grid_x, grid_y = building.grid_x, building.grid_y
+        paid = BUILDINGS[building_type]["current_cost"]
+        district = self.touch_district(building)
+        self.buildings.append(building)
+        self.buildings_changed = True
+        self.occupy_grid(grid_x, grid_y, code)
+        if self.journal is not None:
+            self.journal.append(["place", code, grid_x, grid_y])
+        self.resources -= paid
+        if code == FACTORY:
+            self.add_emission_source(grid_x, grid_y, code)
+        if code in PRODUCTION_PERIODS:
+            district.workplaces.append(building)
+            self.schedule_production(building, PRODUCTION_PERIODS[code])
+        joined = self.index_building(building)
+
+        # Only the neighbourhood of the new building needs re-matching
+        if code == HOUSE:
+            self.hire_from_house(building)
+        elif code in WORKPLACES:
+            self.staff_workplace(building)
+        elif code == RAILROAD:
+            self.rematch_beside_rail(joined)
         
         if building_type == "railroad":
-            railroad_count = sum(1 for b in self.buildings if b["type"] == "railroad")
-            BUILDINGS["railroad"]["current_cost"] += railroad_count
+            cost_increase = self.type_counts[RAILROAD]
         else:
-            BUILDINGS[building_type]["current_cost"] += 1
+            cost_increase = 1
+        BUILDINGS[building_type]["current_cost"] += cost_increase
         
         if BUILD_SOUND:
             BUILD_SOUND.play()
+        return paid, cost_increase
 
-    def add_building(self, x, y):
-        grid_x = x // GRID_SIZE
-        grid_y = y // GRID_SIZE
-        self.add_building_to_grid(grid_x, grid_y, self.current_building)
+    def remove_building(self, building):
+        # Reverses place_building. Undo removes the newest buildings first,
+        # so the common case is a pop from the end of the list.
+        code = building.code
+        district = self.touch_district(building)
+        if self.buildings and self.buildings[-1] is building:
+            self.buildings.pop()
+        else:
+            self.buildings.remove(building)
+        self.buildings_changed = True
+        if self.journal is not None:
+            self.journal.append(["remove", code, building.grid_x, building.grid_y])
+            self.activity_changes.pop(building, None)
+        self.clear_grid(building.grid_x, building.grid_y, code)
+        if code == FACTORY:
+            self.add_emission_source(building.grid_x, building.grid_y, code, -1)
+        if building.production:
+            self.scheduler.cancel(building.production)
+            building.production = None
+        if code in PRODUCTION_PERIODS:
+            district.workplaces.remove(building)
+        self.unindex_building(building)
 
-    def assign_workers(self):
-        house_count = sum(1 for b in self.buildings if b["type"] == "house")
-        total_workers = house_count * HOUSE_CAPACITY
-        workers_available = total_workers
+    def restore_building(self, building):
+        # Puts back a demolished building without charging for it
+        paid, cost_increase = self.place_building(building)
+        self.resources += paid
+        BUILDINGS[building.type]["current_cost"] -= cost_increase
 
-        for building in self.buildings:
-            if building["type"] in ["factory", "farm", "mine"]:
-                building["active"] = False
+    def building_at(self, grid_x, grid_y):
+        # The building covering a tile, found through the rail and worker indexes
+        if not (0 <= grid_x < GRID_WIDTH and 0 <= grid_y < GRID_HEIGHT):
+            return None
+        code = self.grid[grid_x, grid_y]
+        if code == EMPTY:
+            return None
+        if code == RAILROAD:
+            return self.rail_tiles.get((grid_x, grid_y))
+        buckets = self.house_buckets if code == HOUSE else self.workplace_buckets
+        bucket_x, bucket_y = grid_x // WORKER_BUCKET, grid_y // WORKER_BUCKET
+        for i in (bucket_x - 1, bucket_x):
+            for j in (bucket_y - 1, bucket_y):
+                for building in buckets.get((i, j), ()):
+                    grid_w, grid_h = BUILDING_SIZES[building.code]
+                    if (building.grid_x <= grid_x < building.grid_x + grid_w and
+                            building.grid_y <= grid_y < building.grid_y + grid_h):
+                        return building
+        return None
+
+    def demolish_at(self, grid_x, grid_y):
+        # Bulldozer: free, refunds nothing and leaves building costs as they are
+        building = self.building_at(grid_x, grid_y)
+        if building is None:
+            return
+        self.remove_building(building)
+        command = self.command_for(DemolishCommand)
+        command.removals.append(building)
+        if command is not self.open_command:
+            self.history.push(command)
+
+    def begin_command(self, demolish=False):
+        self.end_command()  # A drag started during another one ends it
+        self.open_command = DemolishCommand() if demolish else PlaceCommand()
+
+    def command_for(self, kind):
+        # Command an edit of this kind is recorded in. During a drag that's
+        # the open command; one of the other kind is pushed first, so the
+        # history keeps the edits in the order they happened.
+        if self.open_command is None:
+            return kind()
+        if not isinstance(self.open_command, kind):
+            self.end_command()
+            self.open_command = kind()
+        return self.open_command
+
+    def end_command(self):
+        if self.open_command:
+            self.history.push(self.open_command)
+        self.open_command = None
+
+    def undo(self):
+        self.end_command()
+        self.history.undo(self)
+
+    def redo(self):
+        self.end_command()
+        self.history.redo(self)
+
+    def workers_required(self, code):
+        if code == FACTORY:
+            return WORKERS_PER_FACTORY
+        elif code == FARM:
+            return WORKERS_PER_FARM
+        elif code == MINE:
+            return WORKERS_PER_MINE
+        return 0
+
+    def bucket_of(self, building):
+        return building.grid_x // WORKER_BUCKET, building.grid_y // WORKER_BUCKET
+
+    def index_building(self, building):
+        if building.code == HOUSE:
+            self.house_buckets.setdefault(self.bucket_of(building), []).append(building)
+            cell = (building.grid_x // POLLUTION_CELL, building.grid_y // POLLUTION_CELL)
+            self.houses_by_cell.setdefault(cell, []).append(building)
+            building.capacity = self.house_capacity(building)
+            building.employed = 0
+            building.jobs = {}
+            self.total_workers += building.capacity
+            self.available_workers += building.capacity
+        elif building.code in WORKPLACES:
+            self.workplace_buckets.setdefault(self.bucket_of(building), []).append(building)
+            building.crew = {}
+            if building.active and self.activity_changes is not None:
+                # A re-solve starts every workplace idle; clients have to hear
+                # about it unless staff_workplace turns it back on
+                self.activity_changes[building] = False
+            building.active = False
+            self.unstaffed[building] = True
+        elif building.code == RAILROAD:
+            return self.link_rail(building)  # Tiles that joined the network
+
+    def unindex_building(self, building):
+        if building.code == HOUSE:
+            self.house_buckets[self.bucket_of(building)].remove(building)
+            cell = (building.grid_x // POLLUTION_CELL, building.grid_y // POLLUTION_CELL)
+            self.houses_by_cell[cell].remove(building)
+            laid_off = self.release_workplaces(list(building.jobs))
+            self.total_workers -= building.capacity
+            self.available_workers -= building.capacity
+            self.rehire(laid_off, gone=building)
+        elif building.code in WORKPLACES:
+            self.workplace_buckets[self.bucket_of(building)].remove(building)
+            houses = list(building.crew)
+            if building.active:
+                self.release_workplace(building)
+            del self.unstaffed[building]
+            for house in houses:
+                self.hire_from_house(house)
+        elif building.code == RAILROAD:
+            self.unlink_rail(building)
+
+    def nearby(self, buckets, building, radius):
+        bx, by = self.bucket_of(building)
+        reach = int(radius) // WORKER_BUCKET + 1
+        for i in range(bx - reach, bx + reach + 1):
+            for j in range(by - reach, by + reach + 1):
+                yield from buckets.get((i, j), ())
+
+    def commute_radius(self, building):
+        # Rail-linked buildings can reach further, so search a wider area
+        if self.is_adjacent_to_railroad(building):
+            return MAX_COMMUTE / RAIL_COMMUTE_FACTOR
+        return MAX_COMMUTE
+
+    def commute_distance(self, house, workplace):
+        work_w, work_h = BUILDING_SIZES[workplace.code]
+        distance = (abs(workplace.grid_x + work_w / 2 - house.grid_x - 0.5) +
+                    abs(workplace.grid_y + work_h / 2 - house.grid_y - 0.5))
+        if self.is_adjacent_to_railroad(house) and self.is_adjacent_to_railroad(workplace):
+            distance *= RAIL_COMMUTE_FACTOR
+        return distance
+
+    def staff_workplace(self, workplace):
+        # A workplace only runs with a full crew, so hire from the nearest
+        # houses with spare workers only when together they cover the need
+        if workplace.active:
+            return True
+        needed = self.workers_required(workplace.code)
+        candidates = []
+        for house in self.nearby(self.house_buckets, workplace, self.commute_radius(workplace)):
+            spare = house.capacity - house.employed
+            if spare > 0:
+                distance = self.commute_distance(house, workplace)
+                if distance <= MAX_COMMUTE:
+                    candidates.append((distance, house, spare))
+        if sum(spare for _, _, spare in candidates) < needed:
+            return False
+
+        candidates.sort(key=lambda candidate: candidate[0])
+        self.settle_workplace(workplace)
+        self.available_workers -= needed
+        for _, house, spare in candidates:
+            hired = min(spare, needed)
+            house.employed += hired
+            house.jobs[workplace] = hired
+            workplace.crew[house] = hired
+            needed -= hired
+            if needed == 0:
+                break
+        workplace.active = True
+        self.buildings_changed = True
+        self.worker_version += 1
+        if self.activity_changes is not None:
+            self.activity_changes[workplace] = True
+        del self.unstaffed[workplace]
+        return True
+
+    def release_workplace(self, workplace):
+        self.settle_workplace(workplace)
+        for house, hired in workplace.crew.items():
+            house.employed -= hired
+            del house.jobs[workplace]
+            self.available_workers += hired
+        workplace.crew = {}
+        workplace.active = False
+        self.buildings_changed = True
+        self.worker_version += 1
+        if self.activity_changes is not None:
+            self.activity_changes[workplace] = False
+        self.unstaffed[workplace] = True
+
+    def release_workplaces(self, workplaces):
+        # Returns {workplace: houses of its former crew}, for rehire
+        laid_off = {workplace: list(workplace.crew) for workplace in workplaces}
+        for workplace in laid_off:
+            self.release_workplace(workplace)
+        return laid_off
+
+    def rehire(self, laid_off, gone=None):
+        # Laid-off workplaces hire again first. One that can't leaves its
+        # former crew's houses with spare workers, which go to other idle
+        # workplaces in reach. gone is a house being demolished.
+        for workplace in laid_off:
+            self.staff_workplace(workplace)
+        for workplace, houses in laid_off.items():
+            if not workplace.active:
+                for house in houses:
+                    if house is not gone and house.employed < house.capacity:
+                        self.hire_from_house(house)
+
+    def hire_from_house(self, house):
+        # Offer a house's spare workers to the closest idle workplaces
+        waiting = [w for w in self.nearby(self.workplace_buckets, house, self.commute_radius(house))
+                   if not w.active]
+        waiting.sort(key=lambda w: self.commute_distance(house, w))
+        for workplace in waiting:
+            if house.employed >= house.capacity:
+                break
+            self.staff_workplace(workplace)
+
+    def set_house_capacity(self, house, capacity):
+        change = capacity - house.capacity
+        house.capacity = capacity
+        self.worker_version += 1
+        self.total_workers += change
+        self.available_workers += change
+        laid_off = {}
+        while house.employed > capacity:
+            laid_off.update(self.release_workplaces([next(iter(house.jobs))]))
+        self.rehire(laid_off)
+        if house.employed < capacity:
+            self.hire_from_house(house)
+
+    def refresh_house_capacities(self):
+        # Only houses in pollution cells whose capacity changed are revisited
+        capacities = self.compute_house_capacities()
+        changed = np.argwhere(capacities != self.house_capacity_field)
+        self.house_capacity_field = capacities
+        for cx, cy in changed:
+            for house in self.houses_by_cell.get((int(cx), int(cy)), ()):
+                self.set_house_capacity(house, int(capacities[cx, cy]))
 
+    def assign_workers(self):
+        # Full re-solve, used at start-up and when research changes worker numbers
+        self.house_buckets = {}
+        self.workplace_buckets = {}
+        self.houses_by_cell = {}
+        self.unstaffed = {}
+        self.rail_tiles = {}
+        self.rail_labels = {}
+        self.rail_components = {}
+        self.rail_root = None
+        self.house_capacity_field = self.compute_house_capacities()
+        self.worker_version += 1
+        self.total_workers = 0
+        self.available_workers = 0
         for building in self.buildings:
-            if building["type"] == "factory" and workers_available >= WORKERS_PER_FACTORY:
-                workers_available -= WORKERS_PER_FACTORY
-                building["active"] = True
-            elif building["type"] == "farm" and workers_available >= WORKERS_PER_FARM:
-                workers_available -= WORKERS_PER_FARM
-                building["active"] = True
-            elif building["type"] == "mine" and workers_available >= WORKERS_PER_MINE:
-                workers_available -= WORKERS_PER_MINE
-                building["active"] = True
-        
-        self.total_workers = total_workers
-        self.available_workers = workers_available
+            self.index_building(building)
+        for building in self.buildings:
+            if building.code in WORKPLACES:
+                self.staff_workplace(building)
 
     def update_pollution(self):
-        current_time = pygame.time.get_ticks()
+        current_time = self.get_ticks()
+        if current_time - self.last_pollution_time < POLLUTION_TICK:
+            return
         elapsed_time = (current_time - self.last_pollution_time) / 1000
-        factory_count = sum(1 for b in self.buildings if b["type"] == "factory")
-        self.pollution += factory_count * elapsed_time
+        field = self.pollution_field
+        self.settle_districts()  # Farm yields are about to change
+
+        # Emit, diffuse with a 5-point stencil, then decay. All in place so
+        # large maps don't allocate a new grid every step.
+        field += self.emission_field * elapsed_time
+        laplacian = self.pollution_scratch
+        np.multiply(field, -4, out=laplacian)
+        laplacian[1:] += field[:-1]
+        laplacian[:-1] += field[1:]
+        laplacian[:, 1:] += field[:, :-1]
+        laplacian[:, :-1] += field[:, 1:]
+        # Map edges reflect, so no pollution leaks off the map
+        laplacian[0] += field[0]
+        laplacian[-1] += field[-1]
+        laplacian[:, 0] += field[:, 0]
+        laplacian[:, -1] += field[:, -1]
+        laplacian *= POLLUTION_DIFFUSION
+        field += laplacian
+        field *= max(0.0, 1 - POLLUTION_DECAY * elapsed_time)
+
+        self.pollution = float(field.sum())
         self.last_pollution_time = current_time
+        self.refresh_house_capacities()
 
     def get_connected_railroads(self):
-        railroad_tiles = [(b["grid_x"], b["grid_y"]) for b in self.buildings if b["type"] == "railroad"]
-        if not railroad_tiles:
+        if self.rail_root is None:
             return set()
-        
-        visited = set()
-        to_visit = [railroad_tiles[0]]
-        
-        while to_visit:
-            x, y = to_visit.pop()
-            if (x, y) not in visited:
-                visited.add((x, y))
-                for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
-                    nx, ny = x + dx, y + dy
-                    if (nx, ny) in railroad_tiles and (nx, ny) not in visited:
-                        to_visit.append((nx, ny))
-        
-        return visited
+        return self.rail_components[self.rail_labels[self.rail_root]]
+
+    def rail_neighbours(self, tile):
+        x, y = tile
+        for neighbour in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+            if neighbour in self.rail_labels:
+                yield neighbour
+
+    def new_rail_component(self, tiles):
+        label = self.next_rail_label
+        self.next_rail_label += 1
+        self.rail_components[label] = tiles
+        for tile in tiles:
+            self.rail_labels[tile] = label
+        return label
+
+    def link_rail(self, building):
+        # Join the largest neighbouring component; smaller ones are relabelled
+        # into it. Returns the tiles that joined the network.
+        tile = (building.grid_x, building.grid_y)
+        self.settle_districts(stale=True)  # Rail bonuses are about to change
+        self.rail_tiles[tile] = building
+        labels = list(dict.fromkeys(self.rail_labels[n] for n in self.rail_neighbours(tile)))
+        joined = []
+        if self.rail_root is None:
+            joined.append(tile)
+        elif self.rail_labels[self.rail_root] in labels:
+            network_label = self.rail_labels[self.rail_root]
+            joined.append(tile)
+            for label in labels:
+                if label != network_label:
+                    joined.extend(self.rail_components[label])
+        if not labels:
+            self.new_rail_component({tile})
+        else:
+            label = max(labels, key=lambda l: len(self.rail_components[l]))
+            component = self.rail_components[label]
+            for other in labels:
+                if other != label:
+                    for other_tile in self.rail_components.pop(other):
+                        self.rail_labels[other_tile] = label
+                        component.add(other_tile)
+            component.add(tile)
+            self.rail_labels[tile] = label
+        if self.rail_root is None:
+            self.rail_root = tile
+        return joined
+
+    def unlink_rail(self, building):
+        tile = (building.grid_x, building.grid_y)
+        self.settle_districts(stale=True)
+        network = self.get_connected_railroads()
+        label = self.rail_labels.pop(tile)
+        del self.rail_tiles[tile]
+        component = self.rail_components[label]
+        component.discard(tile)
+        parts = [component] + self.split_rail_component(label, list(self.rail_neighbours(tile)))
+        if not component:
+            del self.rail_components[label]
+        if tile == self.rail_root:
+            # Removed buildings are already out of the list, so this is the next oldest track
+            root = next((b for b in self.buildings if b.code == RAILROAD), None)
+            self.rail_root = (root.grid_x, root.grid_y) if root else None
+
+        # Only tiles that left the network change anyone's commute
+        new_network = self.get_connected_railroads()
+        if network is component:
+            lost = [tile]
+            for part in parts:
+                if part is not new_network:
+                    lost.extend(part)
+            self.recheck_rail_commuters(lost)
+        if not any(part is new_network for part in parts) and new_network:
+            # The oldest track now sits on another component, which joins the network
+            self.rematch_beside_rail(new_network)
+
+    def split_rail_component(self, label, starts):
+        # Removing a tile may cut its component apart. One search starts
+        # from each remaining neighbour and they advance a tile at a time in
+        # turn. Searches that meet are merged; a search that runs out of
+        # track while another is still going has found a piece that split
+        # off, and only that piece is relabelled. The work is bounded by
+        # the smaller sides of the cut, not by the size of the network.
+        pieces = []
+        if len(starts) < 2:
+            return pieces
+        owner = {start: i for i, start in enumerate(starts)}
+        parent = list(range(len(starts)))
+        frontiers = [deque([start]) for start in starts]
+        found = [[start] for start in starts]
+        live = set(range(len(starts)))
+
+        def find(i):
+            while parent[i] != i:
+                i = parent[i]
+            return i
+
+        while len(live) > 1:
+            for i in sorted(live):
+                if i not in live or len(live) == 1:
+                    continue
+                if not frontiers[i]:
+                    live.remove(i)
+                    piece = set(found[i])
+                    self.rail_components[label] -= piece
+                    self.new_rail_component(piece)
+                    pieces.append(piece)
+                    continue
+                x, y = frontiers[i].popleft()
+                for neighbour in self.rail_neighbours((x, y)):
+                    j = owner.get(neighbour)
+                    if j is None:
+                        owner[neighbour] = i
+                        found[i].append(neighbour)
+                        frontiers[i].append(neighbour)
+                        continue
+                    j = find(j)
+                    if j != i:
+                        keep, gone = (i, j) if len(found[i]) >= len(found[j]) else (j, i)
+                        parent[gone] = keep
+                        found[keep].extend(found[gone])
+                        frontiers[keep].extend(frontiers[gone])
+                        live.remove(gone)
+                        i = keep
+        return pieces
+
+    def rematch_beside_rail(self, tiles):
+        # Buildings beside track that joined the network can now commute
+        # further: idle workplaces there try to hire again, and houses there
+        # offer their spare workers again
+        for x, y in tiles:
+            for nx, ny in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+                building = self.building_at(nx, ny)
+                if building is None:
+                    continue
+                if building.code == HOUSE:
+                    if building.employed < building.capacity:
+                        self.hire_from_house(building)
+                elif building in self.unstaffed:
+                    self.staff_workplace(building)
+
+    def recheck_rail_commuters(self, tiles):
+        # Buildings beside track that left the network may now commute too far
+        workplaces = {}
+        for x, y in tiles:
+            for nx, ny in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+                building = self.building_at(nx, ny)
+                if building is None:
+                    continue
+                if building.code == HOUSE:
+                    workplaces.update(dict.fromkeys(building.jobs, True))
+                elif building.code in WORKPLACES and building.active:
+                    workplaces[building] = True
+        too_far = [workplace for workplace in workplaces
+                   if workplace.active and any(self.commute_distance(house, workplace) > MAX_COMMUTE
+                                               for house in workplace.crew)]
+        self.rehire(self.release_workplaces(too_far))
 
     def is_adjacent_to_railroad(self, building):
-        grid_w, grid_h = BUILDINGS[building["type"]]["grid_size"]
-        building_x, building_y = building["grid_x"], building["grid_y"]
+        grid_w, grid_h = BUILDING_SIZES[building.code]
+        building_x, building_y = building.grid_x, building.grid_y
         railroad_tiles = self.get_connected_railroads()
 
         for i in range(grid_w):
@@ -316,61 +1565,526 @@ class CityBuilder:
                         return True
         return False
 
+    def schedule_production(self, building, delay):
+        due = self.get_ticks() + delay
+        building.production = self.scheduler.schedule(due, self.run_production_cycle, building, due)
+
+    def base_yield(self, building):
+        # Output per cycle before the pollution penalty on farms
+        code = building.code
+        if code == FACTORY:
+            output = FACTORY_PRODUCTION
+        elif code == FARM:
+            output = FARM_PRODUCTION
+        else:
+            output = MINE_PRODUCTION
+        if self.is_adjacent_to_railroad(building):
+            output += PRODUCTION_BASE_YIELDS[code] * 0.01 * len(self.get_connected_railroads())
+        if code in (FARM, MINE):
+            output *= DEPOSIT_FLOOR + (DEPOSIT_PEAK - DEPOSIT_FLOOR) * self.terrain.richness(building)
+        return output
+
+    def production_yield(self, building):
+        output = self.base_yield(building)
+        if building.code == FARM:
+            output *= 1 - self.pollution_penalty(building, FARM_POLLUTION_PENALTY)
+        return output
+
+    def run_production_cycle(self, building, due):
+        if building.active:
+            self.resources += self.production_yield(building)
+            self.produced = True
+        # Schedule from the due time, not the current time, so the cycle keeps its phase
+        next_due = due + PRODUCTION_PERIODS[building.code]
+        building.production = self.scheduler.schedule(next_due, self.run_production_cycle, building, next_due)
+
     def produce_resources(self):
-        current_time = pygame.time.get_ticks()
-        produced = False
-        railroad_count = len(self.get_connected_railroads())
-
-        if current_time - self.last_factory_production >= 5000:
-            active_factories = [b for b in self.buildings if b["type"] == "factory" and b["active"]]
-            for factory in active_factories:
-                base_yield = 10
-                bonus = base_yield * 0.01 * railroad_count if self.is_adjacent_to_railroad(factory) else 0
-                self.resources += FACTORY_PRODUCTION + bonus
-            self.last_factory_production = current_time
-            if active_factories:
-                produced = True
-
-        if current_time - self.last_farm_production >= 10000:
-            active_farms = [b for b in self.buildings if b["type"] == "farm" and b["active"]]
-            for farm in active_farms:
-                base_yield = 20
-                bonus = base_yield * 0.01 * railroad_count if self.is_adjacent_to_railroad(farm) else 0
-                self.resources += FARM_PRODUCTION + bonus
-            self.last_farm_production = current_time
-            if active_farms:
-                produced = True
-
-        if current_time - self.last_mine_production >= 10000:
-            active_mines = [b for b in self.buildings if b["type"] == "mine" and b["active"]]
-            for mine in active_mines:
-                base_yield = 20
-                bonus = base_yield * 0.01 * railroad_count if self.is_adjacent_to_railroad(mine) else 0
-                self.resources += MINE_PRODUCTION + bonus
-            self.last_mine_production = current_time
-            if active_mines:
-                produced = True
-
-        if produced and RESOURCE_SOUND:
+        self.produced = False
+        now = self.get_ticks()
+        self.scheduler.run_due(now)
+        self.last_production_time = now
+        if now - self.last_district_time >= DISTRICT_TICK:
+            self.update_districts(now)
+        if self.produced and RESOURCE_SOUND:
             RESOURCE_SOUND.play()
 
+    def district_of(self, building):
+        key = (building.grid_x // DISTRICT_SIZE, building.grid_y // DISTRICT_SIZE)
+        district = self.districts.get(key)
+        if district is None:
+            district = self.districts[key] = District()
+        return district
+
+    def touch_district(self, building):
+        # An edit brings the building's district to full detail for a while
+        district = self.district_of(building)
+        district.last_edit = self.get_ticks()
+        if district.coarse:
+            self.refine_district(district)
+        return district
+
+    def update_districts(self, now):
+        # Pay out coarse districts, then move districts between levels as
+        # the view and the edits move. Runs after the step's production
+        # events, so every detailed cycle due by now has already been paid.
+        self.last_district_time = now
+        self.settle_districts(now)
+        scale = GRID_SIZE // self.tile_size
+        left = (self.camera_x // GRID_SIZE - DISTRICT_VIEW_MARGIN) // DISTRICT_SIZE
+        top = (self.camera_y // GRID_SIZE - DISTRICT_VIEW_MARGIN) // DISTRICT_SIZE
+        right = (self.camera_x // GRID_SIZE + VIEW_WIDTH * scale + DISTRICT_VIEW_MARGIN) // DISTRICT_SIZE
+        bottom = (self.camera_y // GRID_SIZE + VIEW_HEIGHT * scale + DISTRICT_VIEW_MARGIN) // DISTRICT_SIZE
+        for (district_x, district_y), district in self.districts.items():
+            detailed = ((left <= district_x <= right and top <= district_y <= bottom) or
+                        now - district.last_edit < DISTRICT_EDIT_HOLD)
+            if detailed and district.coarse:
+                self.refine_district(district)
+            elif not detailed and not district.coarse and district.workplaces:
+                self.coarsen_district(district)
+
+    def coarsen_district(self, district):
+        # Hand the production events over to arrays. Each workplace keeps its
+        # own due time, so refining later resumes every cycle in phase.
+        workplaces = district.workplaces
+        district.due = np.array([b.production.time for b in workplaces], dtype=np.int64)
+        for building in workplaces:
+            self.scheduler.cancel(building.production)
+            building.production = None
+        district.periods = np.array([PRODUCTION_PERIODS[b.code] for b in workplaces], dtype=np.int64)
+        district.next_due = int(district.due.min())
+        district.stale = True
+
+        # Farms average the pollution cells under them, as in local_pollution
+        farms = [i for i, building in enumerate(workplaces) if building.code == FARM]
+        if farms:
+            cells = []
+            for i in farms:
+                x0, y0, x1, y1 = self.pollution_span(workplaces[i])
+                cells.append([(cx, cy) for cx in range(x0, x1) for cy in range(y0, y1)])
+            width = max(len(c) for c in cells)
+            district.farms = np.array(farms)
+            district.farm_cells = np.array([c + [c[0]] * (width - len(c)) for c in cells])
+            district.farm_weights = np.array([[1 / len(c)] * len(c) + [0.0] * (width - len(c)) for c in cells])
+        district.coarse = True
+
+    def refine_district(self, district):
+        # Back to one event per workplace, from where the arrays left off
+        self.settle_district(district, self.last_production_time)
+        for building, due in zip(district.workplaces, district.due.tolist()):
+            building.production = self.scheduler.schedule(due, self.run_production_cycle, building, due)
+        district.coarse = False
+        district.due = district.periods = district.next_due = district.yields = None
+        district.farms = district.farm_cells = district.farm_weights = None
+
+    def settle_district(self, district, limit):
+        # Pay every cycle due by limit at the current yields. Anything a
+        # yield depends on settles first before it changes (settle_districts,
+        # settle_workplace), so each cycle is paid what its own production
+        # event would have paid, whichever level the district was at.
+        if district.next_due > limit:
+            return
+        if district.stale:
+            district.yields = np.array([self.base_yield(b) if b.active else 0.0 for b in district.workplaces])
+            district.stale = False
+        yields = district.yields
+        if district.farms is not None:
+            cells = district.farm_cells
+            local = (self.pollution_field[cells[..., 0], cells[..., 1]] * district.farm_weights).sum(axis=1)
+            yields = yields.copy()
+            yields[district.farms] *= 1 - np.minimum(MAX_POLLUTION_PENALTY, local * FARM_POLLUTION_PENALTY)
+        due, periods = district.due, district.periods
+        ready = due <= limit
+        cycles = (limit - due[ready]) // periods[ready] + 1
+        self.resources += float((cycles * yields[ready]).sum())
+        due[ready] += cycles * periods[ready]
+        district.next_due = int(due.min())
+
+    def settle_districts(self, limit=None, stale=False):
+        # Settle every coarse district up to the last production step (by
+        # default), before a change that affects yields. stale marks the
+        # yields for recomputing, for changes that aren't pollution.
+        if limit is None:
+            limit = self.last_production_time
+        for district in self.districts.values():
+            if district.coarse:
+                self.settle_district(district, limit)
+                district.stale = district.stale or stale
+
+    def settle_workplace(self, workplace):
+        # Before a workplace starts or stops running
+        district = self.district_of(workplace)
+        if district.coarse:
+            self.settle_district(district, self.last_production_time)
+            district.stale = True
+
     def get_tech_cost(self, tech_key):
         researched_count = len(self.researched_technologies)
         base_cost = TECHNOLOGIES[tech_key]["base_cost"]
         return base_cost * (2 ** researched_count)
 
+    def research_by_key(self, tech_key):
+        self.research_technology(tech_list.index(tech_key))
+
     def research_technology(self, index):
-        if index < len(tech_list):
+        if 0 <= index < len(tech_list):
             tech_key = tech_list[index]
             if tech_key not in self.researched_technologies:
                 current_cost = self.get_tech_cost(tech_key)
                 if self.resources >= current_cost:
                     self.resources -= current_cost
+                    tuning_before = {name: globals()[name] for name in TUNING_NAMES}
+                    self.settle_districts(stale=True)
                     TECHNOLOGIES[tech_key]["effect"]()
                     self.researched_technologies.add(tech_key)
                     self.assign_workers()
+                    # Only the globals the effect changed go into the undo delta
+                    changed = [name for name in TUNING_NAMES if globals()[name] != tuning_before[name]]
+                    self.history.push(ResearchCommand(
+                        tech_key, current_cost,
+                        {name: tuning_before[name] for name in changed},
+                        {name: globals()[name] for name in changed}
+                    ))
+
+    def snapshot(self):
+        # Cheap, consistent copy of the saved state, taken on the main thread.
+        # A building's type and position never change after placement, so a
+        # shallow copy of the list is enough for the writer thread to read.
+        self.settle_districts()
+        return {
+            "resources": self.resources,
+            "buildings": list(self.buildings),
+            "grid": self.grid.copy(),
+            "pollution_field": self.pollution_field.copy(),
+            "researched": sorted(self.researched_technologies),
+            "costs": {name: spec["current_cost"] for name, spec in BUILDINGS.items()},
+            "tuning": {name: globals()[name] for name in TUNING_NAMES},
+            "seed": self.terrain.seed
+        }
+
+    def update_autosave(self):
+        if not self.autosave_enabled:
+            return
+        current_time = self.get_ticks()
+        if current_time - self.last_autosave_time < AUTOSAVE_INTERVAL:
+            return
+        if self.autosave_thread and self.autosave_thread.is_alive():
+            return  # Previous save still writing; try again next frame
+        path = os.path.join(AUTOSAVE_DIR, f"autosave_{self.autosave_slot}.npz")
+        self.autosave_slot = (self.autosave_slot + 1) % AUTOSAVE_SLOTS
+        self.autosave_thread = threading.Thread(target=write_save, args=(self.snapshot(), path), daemon=True)
+        self.autosave_thread.start()
+        self.last_autosave_time = current_time
 
-    def draw_tech_menu(self, screen):
+    def load_game(self, path):
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            rows = data["buildings"]
+            self.grid = data["grid"]
+            self.pollution_field = data["pollution_field"]
+        self.occupied_version += 1
+        self.update_minimap_rows(0, GRID_HEIGHT)
+
+        globals().update(meta["tuning"])
+        for name, cost in meta["costs"].items():
+            BUILDINGS[name]["current_cost"] = cost
+        self.resources = meta["resources"]
+        self.researched_technologies = set(meta["researched"])
+        seed = meta.get("seed", self.terrain.seed)  # Saves from before terrain have none
+        if seed != self.terrain.seed:
+            self.terrain = Terrain(seed)
+
+        self.history = CommandHistory()
+        self.open_command = None
+        self.buildings = [Building(int(code), int(grid_x), int(grid_y)) for code, grid_x, grid_y in rows]
+        self.type_counts = [0] * len(BUILDING_TYPES)
+        self.emission_field[:] = 0
+        for building in self.buildings:
+            self.type_counts[building.code] += 1
+            if building.code == FACTORY:
+                self.add_emission_source(building.grid_x, building.grid_y, FACTORY)
+        self.pollution = float(self.pollution_field.sum())
+        self.smoke_particles = []
+
+        # Placement times aren't saved, so spread the restored production
+        # cycles evenly over each period rather than firing them together
+        self.scheduler = EventScheduler()
+        self.districts = {}
+        workplaces = [b for b in self.buildings if b.code in PRODUCTION_PERIODS]
+        for i, building in enumerate(workplaces):
+            self.district_of(building).workplaces.append(building)
+            period = PRODUCTION_PERIODS[building.code]
+            self.schedule_production(building, int(period * (i + 1) / len(workplaces)))
+        self.buildings_changed = True
+        self.assign_workers()
+
+    def post(self, action, *args):
+        # Called from the input thread; the action runs on the next simulation step
+        self.commands.put((action, args))
+        self.wake.set()
+
+    def step(self):
+        # One simulation step. Runs on the simulation thread, which owns all
+        # game state; other threads only post commands and read frames.
+        step_start = time.perf_counter()
+        self.run_commands()
+        self.update_pollution()
+        self.produce_resources()
+        self.update_smoke()
+        self.update_autosave()
+        self.recorder.record(self.get_ticks(), (
+            self.resources, self.pollution, self.available_workers, self.total_workers,
+            len(self.buildings), (time.perf_counter() - step_start) * 1000, self.frame_ms
+        ))
+        self.next_wake = self.next_wake_time()
+        self.publish_frame()
+
+    def run_commands(self, log_errors=False):
+        # Everything posted since the last step, in order. With log_errors a
+        # failing command is reported and skipped instead of raised.
+        while True:
+            try:
+                action, args = self.commands.get_nowait()
+            except queue.Empty:
+                break
+            if not log_errors:
+                action(*args)
+                continue
+            try:
+                action(*args)
+            except Exception:
+                traceback.print_exc()
+
+    def headless_step(self, log_errors=False):
+        # The simulation alone, for the multiplayer server and headless
+        # runs: no frames, smoke, autosave or metrics, which nobody reads
+        # there. The server passes log_errors, so one client's failing
+        # command doesn't stop the city for everyone.
+        self.run_commands(log_errors)
+        self.update_pollution()
+        self.produce_resources()
+
+    def next_wake_time(self):
+        # Earliest get_ticks time a timer is due: the pollution tick, the
+        # next production event or the next autosave
+        due = self.last_pollution_time + POLLUTION_TICK
+        next_event = self.scheduler.next_time()
+        if next_event is not None:
+            due = min(due, next_event)
+        if self.autosave_enabled:
+            due = min(due, self.last_autosave_time + AUTOSAVE_INTERVAL)
+        if any(district.coarse for district in self.districts.values()):
+            due = min(due, self.last_district_time + DISTRICT_TICK)
+        return due
+
+    def is_idle(self):
+        # Nothing queued and no smoke drifting: stepping before next_wake
+        # would change nothing
+        return self.commands.empty() and not self.smoke_particles
+
+    def publish_frame(self):
+        # The building list is only rebuilt when something was placed or
+        # changed activity; otherwise the previous immutable tuple is reused
+        if self.buildings_changed:
+            rows = []
+            for building in self.buildings:
+                is_vertical = False
+                if building.code == RAILROAD:
+                    grid_x, grid_y = building.grid_x, building.grid_y
+                    # Check for railroad neighbors above or below
+                    is_vertical = ((grid_y > 0 and self.grid[grid_x, grid_y - 1] == RAILROAD) or
+                                   (grid_y < GRID_HEIGHT - 1 and self.grid[grid_x, grid_y + 1] == RAILROAD))
+                rows.append((building.code, building.x, building.y, building.active, is_vertical))
+            self.building_frame = tuple(rows)
+            self.buildings_changed = False
+
+        overlay = self.overlay
+        if overlay is not None:
+            key, layer = self.overlay_layer(overlay)
+            overlay = (overlay, key, layer)
+        if self.grid_frame[0] != self.occupied_version:
+            self.grid_frame = (self.occupied_version, self.grid.copy())
+        self.prepare_terrain()
+
+        self.frames.publish(FrameState(
+            buildings=self.building_frame,
+            smoke=tuple((p["x"], p["y"], p["alpha"]) for p in self.smoke_particles),
+            resources=self.resources,
+            pollution=self.pollution,
+            available_workers=self.available_workers,
+            total_workers=self.total_workers,
+            researched=frozenset(self.researched_technologies),
+            costs={name: spec["current_cost"] for name, spec in BUILDINGS.items()},
+            tuning={name: globals()[name] for name in TUNING_NAMES},
+            overlay=overlay,
+            grid=self.grid_frame[1],
+            occupied_version=self.grid_frame[0]
+        ))
+
+    def prepare_terrain(self):
+        # Generate the chunks in and around the view here, off the render
+        # thread, which only draws chunks that are ready
+        scale = GRID_SIZE // self.tile_size
+        chunk_pixels = TERRAIN_CHUNK * GRID_SIZE
+        left = max(0, self.camera_x // chunk_pixels - 1)
+        top = max(0, self.camera_y // chunk_pixels - 1)
+        right = min((GRID_WIDTH - 1) // TERRAIN_CHUNK, (self.camera_x + WIDTH * scale) // chunk_pixels + 1)
+        bottom = min((GRID_HEIGHT - 1) // TERRAIN_CHUNK, (self.camera_y + HEIGHT * scale) // chunk_pixels + 1)
+        for chunk_x in range(left, right + 1):
+            for chunk_y in range(top, bottom + 1):
+                self.terrain.chunk(chunk_x, chunk_y)
+
+    def overlay_key(self, name):
+        # What each layer is computed from; it's rebuilt when this changes.
+        # Loads and every placement or removal bump occupied_version.
+        if name == "pollution":
+            return self.last_pollution_time, self.occupied_version
+        if name == "rail":
+            return self.occupied_version
+        return self.occupied_version, self.worker_version
+
+    def overlay_layer(self, name):
+        # Cached (key, layer). A new array is built on every change, so
+        # published layers are never written to again.
+        key = self.overlay_key(name)
+        cached = self.overlay_layers.get(name)
+        if cached is None or cached[0] != key:
+            if name == "pollution":
+                layer = self.pollution_layer()
+            elif name == "rail":
+                layer = self.rail_layer()
+            else:
+                layer = self.workers_layer()
+            cached = self.overlay_layers[name] = (key, layer)
+        return cached
+
+    def fill_footprint(self, layer, building, value):
+        grid_w, grid_h = BUILDING_SIZES[building.code]
+        layer[building.grid_x:building.grid_x + grid_w, building.grid_y:building.grid_y + grid_h] = value
+
+    def pollution_layer(self):
+        # Pollution cells quantized to shades, then spread over their tiles
+        levels = np.rint(np.minimum(self.pollution_field / POLLUTION_OVERLAY_MAX, 1) * POLLUTION_OVERLAY_LEVELS)
+        cells = np.maximum(levels, 0).astype(np.uint8)
+        tiles = cells.repeat(POLLUTION_CELL, axis=0).repeat(POLLUTION_CELL, axis=1)
+        return np.ascontiguousarray(tiles[:GRID_WIDTH, :GRID_HEIGHT])
+
+    def rail_layer(self):
+        layer = np.zeros((GRID_WIDTH, GRID_HEIGHT), dtype=np.uint8)
+        layer[self.grid == RAILROAD] = 2  # Cut-off track, unless in the network below
+        network = self.get_connected_railroads()
+        if network:
+            layer[tuple(np.array(list(network)).T)] = 1
+        for district in self.districts.values():
+            for workplace in district.workplaces:
+                self.fill_footprint(layer, workplace, 3 if self.is_adjacent_to_railroad(workplace) else 4)
+        return layer
+
+    def workers_layer(self):
+        # Empty tiles within a plain commute of a house with spare workers
+        # (rail-linked workplaces can hire from further), then every
+        # workplace and house by how it's staffed
+        layer = np.zeros((GRID_WIDTH, GRID_HEIGHT), dtype=np.uint8)
+        houses = [house for bucket in self.house_buckets.values() for house in bucket]
+        spare = [house for house in houses if house.employed < house.capacity]
+        if spare:
+            reach = np.zeros((GRID_WIDTH, GRID_HEIGHT), dtype=bool)
+            reach[[h.grid_x for h in spare], [h.grid_y for h in spare]] = True
+            for _ in range(MAX_COMMUTE):  # Grow by one tile per pass, a diamond of radius MAX_COMMUTE
+                grown = reach.copy()
+                grown[1:] |= reach[:-1]
+                grown[:-1] |= reach[1:]
+                grown[:, 1:] |= reach[:, :-1]
+                grown[:, :-1] |= reach[:, 1:]
+                reach = grown
+            layer[reach & (self.grid == EMPTY)] = 1
+        for district in self.districts.values():
+            for workplace in district.workplaces:
+                self.fill_footprint(layer, workplace, 2 if workplace.active else 3)
+        for house in houses:
+            layer[house.grid_x, house.grid_y] = 4 if house.employed >= house.capacity else 5
+        return layer
+
+    def net_scalars(self):
+        return {
+            "resources": round(self.resources, 2),
+            "pollution": round(self.pollution, 2),
+            "total_workers": self.total_workers,
+            "available_workers": self.available_workers,
+            "researched": sorted(self.researched_technologies),
+            "costs": {name: spec["current_cost"] for name, spec in BUILDINGS.items()},
+            "tuning": {name: globals()[name] for name in TUNING_NAMES}
+        }
+
+    def take_net_delta(self, last_scalars):
+        # Everything that changed since the last call. Cost is proportional
+        # to the number of changes, not the size of the city.
+        changes = self.journal
+        for building, active in self.activity_changes.items():
+            changes.append(["active", building.grid_x, building.grid_y, active])
+        self.journal = []
+        self.activity_changes = {}
+        scalars = {key: value for key, value in self.net_scalars().items() if last_scalars.get(key) != value}
+        last_scalars.update(scalars)
+        return {"changes": changes, "scalars": scalars}
+
+    def apply_net_full(self, message):
+        # Client side: replace the local mirror with the server's city
+        if message["seed"] != self.terrain.seed:
+            self.terrain = Terrain(message["seed"])
+        self.buildings = []
+        self.buildings_at = {}
+        self.districts = {}
+        self.grid[:] = EMPTY
+        self.type_counts = [0] * len(BUILDING_TYPES)
+        for code, grid_x, grid_y, active in message["buildings"]:
+            building = Building(code, grid_x, grid_y, active)
+            self.buildings.append(building)
+            self.buildings_at[(grid_x, grid_y)] = building
+            if code in PRODUCTION_PERIODS:
+                self.district_of(building).workplaces.append(building)
+            grid_w, grid_h = BUILDING_SIZES[code]
+            self.grid[grid_x:grid_x + grid_w, grid_y:grid_y + grid_h] = code
+            self.type_counts[code] += 1
+        self.occupied_version += 1
+        self.buildings_changed = True
+        self.update_minimap_rows(0, GRID_HEIGHT)
+        self.apply_net_scalars(message["scalars"])
+
+    def apply_net_change(self, change):
+        # ["place" or "remove", code, grid_x, grid_y] or ["active", grid_x, grid_y, flag]
+        kind = change[0]
+        if kind == "active":
+            self.buildings_at[(change[1], change[2])].active = change[3]
+            self.buildings_changed = True
+            self.worker_version += 1
+            return
+        code, grid_x, grid_y = change[1:]
+        if kind == "place":
+            building = Building(code, grid_x, grid_y)
+            self.buildings.append(building)
+            self.buildings_at[(grid_x, grid_y)] = building
+            if code in PRODUCTION_PERIODS:
+                self.district_of(building).workplaces.append(building)
+            self.occupy_grid(grid_x, grid_y, building.code)
+        elif kind == "remove":
+            building = self.buildings_at.pop((grid_x, grid_y))
+            self.buildings.remove(building)
+            if code in PRODUCTION_PERIODS:
+                self.district_of(building).workplaces.remove(building)
+            self.clear_grid(grid_x, grid_y, code)
+        self.buildings_changed = True
+
+    def apply_net_scalars(self, scalars):
+        for key in ("resources", "pollution", "total_workers", "available_workers"):
+            if key in scalars:
+                setattr(self, key, scalars[key])
+        if "researched" in scalars:
+            self.researched_technologies = set(scalars["researched"])
+        for name, cost in scalars.get("costs", {}).items():
+            BUILDINGS[name]["current_cost"] = cost
+        globals().update(scalars.get("tuning", {}))
+
+    def draw_tech_menu(self, screen, frame):
         menu_width, menu_height = 600, 400
         menu_x, menu_y = WIDTH // 2 - menu_width // 2, HEIGHT // 2 - menu_height // 2
         pygame.draw.rect(screen, GRAY, (menu_x, menu_y, menu_width, menu_height))
@@ -380,22 +2094,25 @@ class CityBuilder:
 
         for i, tech_key in enumerate(tech_list):
             tech = TECHNOLOGIES[tech_key]
-            if tech_key in self.researched_technologies:
+            if tech_key in frame.researched:
                 text = f"{i+1}. {tech_key.replace('_', ' ').title()} - {tech['description']}"
                 tech_text = self.tech_font.render(text, True, RED)
             else:
-                current_cost = self.get_tech_cost(tech_key)
+                current_cost = TECHNOLOGIES[tech_key]["base_cost"] * (2 ** len(frame.researched))
                 text = f"{i+1}. {tech_key.replace('_', ' ').title()} - Cost: ${current_cost} - {tech['description']}"
                 tech_text = self.tech_font.render(text, True, BLACK)
             screen.blit(tech_text, (menu_x + 10, menu_y + 40 + i * 30))
 
     def update_smoke(self):
-        current_time = pygame.time.get_ticks()
+        current_time = self.get_ticks()
         if current_time - self.last_smoke_time >= 200:  # Emit every 200ms
-            for building in self.buildings:
-                if building["type"] == "factory" and building["active"]:
-                    x = building["x"] + BUILDINGS["factory"]["grid_size"][0] * GRID_SIZE - 5
-                    y = building["y"] - 10
+            # Coarse districts are out of view, so only detailed ones smoke
+            factories = [b for district in self.districts.values() if not district.coarse
+                         for b in district.workplaces if b.code == FACTORY]
+            for building in factories:
+                if building.active:
+                    x = building.x + BUILDING_SIZES[FACTORY][0] * GRID_SIZE - 5
+                    y = building.y - 10
                     self.smoke_particles.append({
                         "x": x + random.uniform(-2, 2),
                         "y": y,
@@ -415,154 +2132,350 @@ class CityBuilder:
                 new_particles.append(particle)
         self.smoke_particles = new_particles
 
+    def move_camera(self, dx, dy):
+        # Camera position and dx, dy are in world pixels (GRID_SIZE per tile)
+        scale = GRID_SIZE // self.tile_size
+        self.camera_x = max(0, min(GRID_WIDTH * GRID_SIZE - WIDTH * scale, self.camera_x + dx))
+        self.camera_y = max(0, min(GRID_HEIGHT * GRID_SIZE - HEIGHT * scale, self.camera_y + dy))
+
+    def set_zoom(self, zoom, x, y):
+        # Change zoom level keeping the world point under screen x, y in place
+        zoom = max(0, min(len(ZOOM_TILE_SIZES) - 1, zoom))
+        old_scale = GRID_SIZE // self.tile_size
+        self.zoom = zoom
+        self.tile_size = ZOOM_TILE_SIZES[zoom]
+        new_scale = GRID_SIZE // self.tile_size
+        self.move_camera(x * (old_scale - new_scale), y * (old_scale - new_scale))
+
+    def screen_to_grid(self, x, y):
+        scale = GRID_SIZE // self.tile_size
+        return (self.camera_x + x * scale) // GRID_SIZE, (self.camera_y + y * scale) // GRID_SIZE
+
+    def minimap_contains(self, x, y):
+        return (MINIMAP_X <= x < MINIMAP_X + MINIMAP_WIDTH and
+                MINIMAP_Y <= y < MINIMAP_Y + MINIMAP_HEIGHT)
+
+    def jump_camera(self, x, y):
+        # Center the view on the tile under a minimap click
+        scale = GRID_SIZE // self.tile_size
+        world_x = (x - MINIMAP_X) * MINIMAP_STEP * GRID_SIZE
+        world_y = (y - MINIMAP_Y) * MINIMAP_STEP * GRID_SIZE
+        self.move_camera(world_x - WIDTH * scale // 2 - self.camera_x, world_y - HEIGHT * scale // 2 - self.camera_y)
+
+    def draw_placement_preview(self, screen, frame):
+        # Tint every tile in view where the selected building could be
+        # anchored, then draw its footprint under the cursor. Everything
+        # comes from the frame; chunks not generated yet count as dry.
+        camera_x, camera_y = self.camera_x, self.camera_y
+        tile_size = self.tile_size
+        scale = GRID_SIZE // tile_size
+        tile_x, tile_y = camera_x // GRID_SIZE, camera_y // GRID_SIZE
+        building_type = self.current_building
+        grid_w, grid_h = BUILDINGS[building_type]["grid_size"]
+        key, overlay = self.valid_anchor_cache
+        new_key = (building_type, tile_x, tile_y, tile_size, frame.occupied_version, len(self.terrain.chunks))
+        if key != new_key:
+            # Summed-area table of just the view, plus the footprint overhang
+            tiles = frame.grid[tile_x:tile_x + WIDTH // tile_size + grid_w,
+                               tile_y:tile_y + HEIGHT // tile_size + grid_h]
+            visible = anchor_mask(summed_area(tiles != EMPTY), grid_w, grid_h)
+            visible &= self.terrain.dry_anchors(building_type, tile_x, tile_y, *visible.shape, generate=False)
+            pixels = np.zeros(visible.shape + (3,), dtype=np.uint8)
+            pixels[visible] = WHITE
+            overlay = pygame.transform.scale(pygame.surfarray.make_surface(pixels),
+                                             (visible.shape[0] * tile_size, visible.shape[1] * tile_size))
+            overlay.set_colorkey(BLACK)
+            overlay.set_alpha(60)
+            self.valid_anchor_cache = (new_key, overlay)
+        screen.blit(overlay, ((tile_x * GRID_SIZE - camera_x) // scale, (tile_y * GRID_SIZE - camera_y) // scale))
+
+        grid_x, grid_y = self.screen_to_grid(*pygame.mouse.get_pos())
+        fits = (0 <= grid_x and 0 <= grid_y and grid_x + grid_w <= GRID_WIDTH and grid_y + grid_h <= GRID_HEIGHT
+                and not (frame.grid[grid_x:grid_x + grid_w, grid_y:grid_y + grid_h] != EMPTY).any()
+                and self.terrain.is_dry(grid_x, grid_y, grid_w, grid_h, generate=False)
+                and frame.resources >= frame.costs[building_type])
+        ghost = pygame.Surface((grid_w * tile_size, grid_h * tile_size), pygame.SRCALPHA)
+        ghost.fill(BUILDING_COLORS[TYPE_CODES[building_type]] + (120,) if fits else (200, 0, 0, 120))
+        screen.blit(ghost, ((grid_x * GRID_SIZE - camera_x) // scale, (grid_y * GRID_SIZE - camera_y) // scale))
+
+    def draw_minimap(self, screen):
+        # Upload only the rows the simulation recolored since the last frame.
+        # Versions are read before the pixels, so a row changed mid-copy is
+        # simply picked up again next frame.
+        versions = self.minimap_row_versions.copy()
+        dirty = np.nonzero(versions != self.minimap_rows_drawn)[0]
+        if len(dirty):
+            row0, row1 = dirty[0], dirty[-1] + 1
+            rows = self.minimap_surface.subsurface((0, row0, MINIMAP_WIDTH, row1 - row0))
+            pygame.surfarray.blit_array(rows, self.minimap_pixels[:, row0:row1])
+            self.minimap_rows_drawn[row0:row1] = versions[row0:row1]
+        screen.blit(self.minimap_surface, (MINIMAP_X, MINIMAP_Y))
+        pygame.draw.rect(screen, BLACK, (MINIMAP_X - 1, MINIMAP_Y - 1, MINIMAP_WIDTH + 2, MINIMAP_HEIGHT + 2), 1)
+
+        # Current view
+        scale = GRID_SIZE * MINIMAP_STEP
+        view_w = min(MINIMAP_WIDTH, WIDTH // self.tile_size // MINIMAP_STEP)
+        view_h = min(MINIMAP_HEIGHT, HEIGHT // self.tile_size // MINIMAP_STEP)
+        pygame.draw.rect(screen, WHITE, (MINIMAP_X + self.camera_x // scale, MINIMAP_Y + self.camera_y // scale,
+                                         view_w, view_h), 1)
+
+    def draw_building(self, screen, code, x, y, active, is_vertical):
+        # Full-detail building at screen position x, y
+        grid_w, grid_h = BUILDING_SIZES[code]
+        pixel_w = grid_w * GRID_SIZE
+        pixel_h = grid_h * GRID_SIZE
+        base_color = BUILDING_COLORS[code]
+        if not active and code != RAILROAD:
+            base_color = tuple(c // 2 for c in base_color)
+
+        if code == HOUSE:
+            # Base structure with gradient
+            for i in range(pixel_h // 2):
+                color = (
+                    max(0, base_color[0] - i * 2),
+                    max(0, base_color[1] - i * 2),
+                    max(0, base_color[2] - i * 2)
+                )
+                pygame.draw.rect(screen, color, (x, y + pixel_h//2 + i, pixel_w, 1))
+            # Pitched roof
+            roof_points = [
+                (x, y + pixel_h//2),
+                (x + pixel_w//2, y),
+                (x + pixel_w, y + pixel_h//2)
+            ]
+            pygame.draw.polygon(screen, DARK_RED, roof_points)
+            # Windows
+            pygame.draw.rect(screen, BEIGE, (x + pixel_w//4, y + 3*pixel_h//4, pixel_w//4, pixel_h//8))
+            pygame.draw.rect(screen, BEIGE, (x + pixel_w//2, y + 3*pixel_h//4, pixel_w//4, pixel_h//8))
+
+        elif code == FACTORY:
+            # Base structure with gradient
+            for i in range(pixel_h):
+                color = (
+                    max(0, base_color[0] - i // 2),
+                    max(0, base_color[1] - i // 2),
+                    max(0, base_color[2] - i // 2)
+                )
+                pygame.draw.rect(screen, color, (x, y + i, pixel_w, 1))
+            # Windows
+            for wx in range(x + pixel_w//4, x + pixel_w, pixel_w//3):
+                for wy in range(y + pixel_h//4, y + pixel_h, pixel_h//3):
+                    pygame.draw.rect(screen, LIGHT_GRAY, (wx, wy, pixel_w//8, pixel_h//8))
+            # Chimneys
+            pygame.draw.rect(screen, DARK_GRAY, (x + pixel_w - 10, y - 15, 5, 15))
+            pygame.draw.rect(screen, DARK_GRAY, (x + pixel_w - 20, y - 10, 5, 10))
+
+        elif code == FARM:
+            # Field base
+            pygame.draw.rect(screen, YELLOW, (x, y, pixel_w, pixel_h))
+            # Barn
+            barn_w, barn_h = pixel_w // 2, pixel_h // 2
+            pygame.draw.rect(screen, RED, (x, y, barn_w, barn_h))
+            pygame.draw.polygon(screen, DARK_RED, [
+                (x, y + barn_h),
+                (x + barn_w//2, y + barn_h//2),
+                (x + barn_w, y + barn_h)
+            ])
+            # Static crops
+            crop_color = GREEN if active else DARK_GREEN
+            for cx in range(x + pixel_w//4, x + pixel_w, 5):
+                for cy in range(y + pixel_h//2, y + pixel_h, 5):
+                    pygame.draw.line(screen, crop_color,
+                                    (cx, cy),
+                                    (cx, cy + 5), 1)
+
+        elif code == MINE:
+            # Ground base
+            pygame.draw.rect(screen, base_color, (x, y, pixel_w, pixel_h))
+            # Mine entrance
+            entrance_h = pixel_h // 2
+            pygame.draw.rect(screen, BLACK, (x + pixel_w//4, y + pixel_h//2, pixel_w//2, entrance_h))
+            # Tracks
+            pygame.draw.line(screen, DARK_GRAY, (x + pixel_w//2, y + pixel_h//2), (x + pixel_w//2, y + pixel_h), 3)
+            for ty in range(y + pixel_h//2, y + pixel_h, 5):
+                pygame.draw.line(screen, DARK_GRAY, (x + pixel_w//2 - 5, ty), (x + pixel_w//2 + 5, ty), 1)
+            # Ore pile
+            pygame.draw.circle(screen, GRAY, (x + 3*pixel_w//4, y + pixel_h//4), 5)
+
+        elif code == RAILROAD:
+            # Track bed
+            pygame.draw.rect(screen, base_color, (x, y, pixel_w, pixel_h))
+            if is_vertical:
+                # Vertical railroad: two vertical rails, horizontal ties
+                pygame.draw.line(screen, BLACK, 
+                                (x + pixel_w//4, y), 
+                                (x + pixel_w//4, y + pixel_h), 2)
+                pygame.draw.line(screen, BLACK, 
+                                (x + 3*pixel_w//4, y), 
+                                (x + 3*pixel_w//4, y + pixel_h), 2)
+                for ty in range(y, y + pixel_h, 5):
+                    pygame.draw.line(screen, DARK_BROWN, 
+                                    (x + pixel_w//4, ty), 
+                                    (x + 3*pixel_w//4, ty), 1)
+            else:
+                # Horizontal railroad: two horizontal rails, vertical ties
+                pygame.draw.line(screen, BLACK, 
+                                (x, y + pixel_h//4), 
+                                (x + pixel_w, y + pixel_h//4), 2)
+                pygame.draw.line(screen, BLACK, 
+                                (x, y + 3*pixel_h//4), 
+                                (x + pixel_w, y + 3*pixel_h//4), 2)
+                for tx in range(x, x + pixel_w, 5):
+                    pygame.draw.line(screen, DARK_BROWN, 
+                                    (tx, y + pixel_h//4), 
+                                    (tx, y + 3*pixel_h//4), 1)
+
+    def build_sprite(self, code, active, is_vertical, tile_size):
+        # Draw the building once at full detail, then shrink it. The margin
+        # keeps the factory chimneys, which stick out above the footprint.
+        grid_w, grid_h = BUILDING_SIZES[code]
+        canvas = pygame.Surface((grid_w * GRID_SIZE, grid_h * GRID_SIZE + SPRITE_MARGIN), pygame.SRCALPHA)
+        self.draw_building(canvas, code, 0, SPRITE_MARGIN, active, is_vertical)
+        scale = GRID_SIZE // tile_size
+        sprite = pygame.transform.smoothscale(canvas, (canvas.get_width() // scale, canvas.get_height() // scale))
+        self.sprites[(code, active, is_vertical, tile_size)] = sprite
+        return sprite
+
+    def draw_terrain(self, screen):
+        # Blit the scaled surface of every chunk in view; publish_frame
+        # has the simulation thread generate them ahead of the camera
+        tile_size = self.tile_size
+        scale = GRID_SIZE // tile_size
+        chunk_pixels = TERRAIN_CHUNK * GRID_SIZE
+        view_w, view_h = WIDTH * scale, HEIGHT * scale
+        for chunk_x in range(self.camera_x // chunk_pixels, (self.camera_x + view_w - 1) // chunk_pixels + 1):
+            for chunk_y in range(self.camera_y // chunk_pixels, (self.camera_y + view_h - 1) // chunk_pixels + 1):
+                screen.blit(self.terrain.surface(chunk_x, chunk_y, tile_size),
+                            ((chunk_x * chunk_pixels - self.camera_x) // scale,
+                             (chunk_y * chunk_pixels - self.camera_y) // scale))
+
+    def draw_tiles(self, screen, frame):
+        # Far zoom: color every tile in view by type code with one palette
+        # lookup, over the terrain colors, upload it through surfarray and
+        # scale it up. The cost depends on the view size, not the number
+        # of buildings.
+        tile_size = self.tile_size
+        tile_x, tile_y = self.camera_x // GRID_SIZE, self.camera_y // GRID_SIZE
+        tiles = frame.grid[tile_x:tile_x + WIDTH // tile_size + 1, tile_y:tile_y + HEIGHT // tile_size + 1]
+        if self.tile_pixels is None or self.tile_pixels.get_size() != tiles.shape:
+            self.tile_pixels = pygame.Surface(tiles.shape)
+        ground = self.terrain.region("colors", tile_x, tile_y, *tiles.shape, generate=False)
+        pixels = np.where((tiles != EMPTY)[..., None], MINIMAP_PALETTE[tiles], ground)
+        pygame.surfarray.blit_array(self.tile_pixels, pixels)
+        size = (tiles.shape[0] * tile_size, tiles.shape[1] * tile_size)
+        if self.tile_surface is None or self.tile_surface.get_size() != size:
+            self.tile_surface = pygame.Surface(size)
+        pygame.transform.scale(self.tile_pixels, size, self.tile_surface)
+        offset_x = (self.camera_x % GRID_SIZE) * tile_size // GRID_SIZE
+        offset_y = (self.camera_y % GRID_SIZE) * tile_size // GRID_SIZE
+        screen.blit(self.tile_surface, (-offset_x, -offset_y))
+
+    def draw_overlay(self, screen, overlay):
+        # The layer is colored into a one pixel per tile surface only when
+        # the simulation publishes a new one, and scaled to the view only
+        # when that or the view's tile position changes. An unchanged
+        # overlay costs one blit per frame.
+        name, key, layer = overlay
+        if self.overlay_map[0] != (name, key):
+            pixels = pygame.Surface((GRID_WIDTH, GRID_HEIGHT))
+            pygame.surfarray.blit_array(pixels, OVERLAY_PALETTES[name][layer])
+            self.overlay_map = ((name, key), pixels)
+
+        tile_size = self.tile_size
+        tile_x, tile_y = self.camera_x // GRID_SIZE, self.camera_y // GRID_SIZE
+        view_key = (self.overlay_map[0], (tile_x, tile_y), tile_size)
+        if self.overlay_view[0] != view_key:
+            view_w = min(WIDTH // tile_size + 1, GRID_WIDTH - tile_x)
+            view_h = min(HEIGHT // tile_size + 1, GRID_HEIGHT - tile_y)
+            view = self.overlay_map[1].subsurface((tile_x, tile_y, view_w, view_h))
+            scaled = pygame.transform.scale(view, (view_w * tile_size, view_h * tile_size))
+            # Run-length encoded, so the transparent tiles cost nothing to blit
+            scaled.set_colorkey(BLACK, pygame.RLEACCEL)
+            scaled.set_alpha(OVERLAY_ALPHA, pygame.RLEACCEL)
+            self.overlay_view = (view_key, scaled)
+        offset_x = (self.camera_x % GRID_SIZE) * tile_size // GRID_SIZE
+        offset_y = (self.camera_y % GRID_SIZE) * tile_size // GRID_SIZE
+        screen.blit(self.overlay_view[1], (-offset_x, -offset_y))
+
+    def draw_overlay_legend(self, screen, name, x, y):
+        title, entries = OVERLAYS[name]
+        screen.blit(self.tech_font.render(f"Overlay: {title}", True, BLACK), (x, y))
+        for color, label in entries:
+            if label:
+                y += 20
+                pygame.draw.rect(screen, color, (x, y + 2, 12, 12))
+                pygame.draw.rect(screen, BLACK, (x, y + 2, 12, 12), 1)
+                screen.blit(self.tech_font.render(label, True, BLACK), (x + 18, y))
+
     def draw(self, screen):
-        # Draw solid background
-        screen.fill(GREEN)
+        # Runs on the render thread and only reads the latest published frame
+        frame = self.frames.read()
+        camera_x, camera_y = self.camera_x, self.camera_y
+
+        # Draw terrain (far zoom draws it with the buildings in draw_tiles)
+        if self.tile_size > TILE_LOD_SIZE:
+            self.draw_terrain(screen)
 
         # Apply pollution tint
-        if self.pollution > 0:
-            tint = min(50, int(self.pollution // 10))
+        if frame.pollution > 0:
+            tint = min(50, int(frame.pollution // 10))
             overlay = pygame.Surface((WIDTH, HEIGHT), pygame.SRCALPHA)
             overlay.fill((100, 100, 50, tint))
             screen.blit(overlay, (0, 0))
 
-        for building in self.buildings:
-            specs = BUILDINGS[building["type"]]
-            x, y = building["x"], building["y"]
-            grid_w, grid_h = specs["grid_size"]
-            pixel_w = grid_w * GRID_SIZE
-            pixel_h = grid_h * GRID_SIZE
-            base_color = specs["color"]
-            if not building.get("active", True) and building["type"] != "railroad":
-                base_color = tuple(c // 2 for c in base_color)
-
-            if building["type"] == "house":
-                # Base structure with gradient
-                for i in range(pixel_h // 2):
-                    color = (
-                        max(0, base_color[0] - i * 2),
-                        max(0, base_color[1] - i * 2),
-                        max(0, base_color[2] - i * 2)
-                    )
-                    pygame.draw.rect(screen, color, (x, y + pixel_h//2 + i, pixel_w, 1))
-                # Pitched roof
-                roof_points = [
-                    (x, y + pixel_h//2),
-                    (x + pixel_w//2, y),
-                    (x + pixel_w, y + pixel_h//2)
-                ]
-                pygame.draw.polygon(screen, DARK_RED, roof_points)
-                # Windows
-                pygame.draw.rect(screen, BEIGE, (x + pixel_w//4, y + 3*pixel_h//4, pixel_w//4, pixel_h//8))
-                pygame.draw.rect(screen, BEIGE, (x + pixel_w//2, y + 3*pixel_h//4, pixel_w//4, pixel_h//8))
-
-            elif building["type"] == "factory":
-                # Base structure with gradient
-                for i in range(pixel_h):
-                    color = (
-                        max(0, base_color[0] - i // 2),
-                        max(0, base_color[1] - i // 2),
-                        max(0, base_color[2] - i // 2)
-                    )
-                    pygame.draw.rect(screen, color, (x, y + i, pixel_w, 1))
-                # Windows
-                for wx in range(x + pixel_w//4, x + pixel_w, pixel_w//3):
-                    for wy in range(y + pixel_h//4, y + pixel_h, pixel_h//3):
-                        pygame.draw.rect(screen, LIGHT_GRAY, (wx, wy, pixel_w//8, pixel_h//8))
-                # Chimneys
-                pygame.draw.rect(screen, DARK_GRAY, (x + pixel_w - 10, y - 15, 5, 15))
-                pygame.draw.rect(screen, DARK_GRAY, (x + pixel_w - 20, y - 10, 5, 10))
-
-            elif building["type"] == "farm":
-                # Field base
-                pygame.draw.rect(screen, YELLOW, (x, y, pixel_w, pixel_h))
-                # Barn
-                barn_w, barn_h = pixel_w // 2, pixel_h // 2
-                pygame.draw.rect(screen, RED, (x, y, barn_w, barn_h))
-                pygame.draw.polygon(screen, DARK_RED, [
-                    (x, y + barn_h),
-                    (x + barn_w//2, y + barn_h//2),
-                    (x + barn_w, y + barn_h)
-                ])
-                # Static crops
-                crop_color = GREEN if building["active"] else DARK_GREEN
-                for cx in range(x + pixel_w//4, x + pixel_w, 5):
-                    for cy in range(y + pixel_h//2, y + pixel_h, 5):
-                        pygame.draw.line(screen, crop_color,
-                                        (cx, cy),
-                                        (cx, cy + 5), 1)
-
-            elif building["type"] == "mine":
-                # Ground base
-                pygame.draw.rect(screen, base_color, (x, y, pixel_w, pixel_h))
-                # Mine entrance
-                entrance_h = pixel_h // 2
-                pygame.draw.rect(screen, BLACK, (x + pixel_w//4, y + pixel_h//2, pixel_w//2, entrance_h))
-                # Tracks
-                pygame.draw.line(screen, DARK_GRAY, (x + pixel_w//2, y + pixel_h//2), (x + pixel_w//2, y + pixel_h), 3)
-                for ty in range(y + pixel_h//2, y + pixel_h, 5):
-                    pygame.draw.line(screen, DARK_GRAY, (x + pixel_w//2 - 5, ty), (x + pixel_w//2 + 5, ty), 1)
-                # Ore pile
-                pygame.draw.circle(screen, GRAY, (x + 3*pixel_w//4, y + pixel_h//4), 5)
-
-            elif building["type"] == "railroad":
-                # Check orientation
-                grid_x, grid_y = building["grid_x"], building["grid_y"]
-                is_vertical = False
-                # Check for railroad neighbors above or below
-                for b in self.buildings:
-                    if b["type"] == "railroad" and b is not building:
-                        if (b["grid_x"] == grid_x and 
-                            (b["grid_y"] == grid_y - 1 or b["grid_y"] == grid_y + 1)):
-                            is_vertical = True
-                            break
-
-                # Track bed
-                pygame.draw.rect(screen, base_color, (x, y, pixel_w, pixel_h))
-                if is_vertical:
-                    # Vertical railroad: two vertical rails, horizontal ties
-                    pygame.draw.line(screen, BLACK, 
-                                    (x + pixel_w//4, y), 
-                                    (x + pixel_w//4, y + pixel_h), 2)
-                    pygame.draw.line(screen, BLACK, 
-                                    (x + 3*pixel_w//4, y), 
-                                    (x + 3*pixel_w//4, y + pixel_h), 2)
-                    for ty in range(y, y + pixel_h, 5):
-                        pygame.draw.line(screen, DARK_BROWN, 
-                                        (x + pixel_w//4, ty), 
-                                        (x + 3*pixel_w//4, ty), 1)
+        # Level of detail follows the zoom: full detail at 1:1, cached
+        # scaled-down sprites in between, one pixel per tile when far out
+        tile_size = self.tile_size
+        scale = GRID_SIZE // tile_size
+        if tile_size <= TILE_LOD_SIZE:
+            self.draw_tiles(screen, frame)
+        else:
+            for code, x, y, active, is_vertical in frame.buildings:
+                grid_w, grid_h = BUILDING_SIZES[code]
+                x = (x - camera_x) // scale
+                y = (y - camera_y) // scale
+                pixel_w = grid_w * tile_size
+                pixel_h = grid_h * tile_size
+                # Skip anything off screen (chimneys reach 15px above a factory)
+                if x >= WIDTH or y - 15 >= HEIGHT or x + pixel_w <= 0 or y + pixel_h <= 0:
+                    continue
+                if scale == 1:
+                    self.draw_building(screen, code, x, y, active, is_vertical)
                 else:
-                    # Horizontal railroad: two horizontal rails, vertical ties
-                    pygame.draw.line(screen, BLACK, 
-                                    (x, y + pixel_h//4), 
-                                    (x + pixel_w, y + pixel_h//4), 2)
-                    pygame.draw.line(screen, BLACK, 
-                                    (x, y + 3*pixel_h//4), 
-                                    (x + pixel_w, y + 3*pixel_h//4), 2)
-                    for tx in range(x, x + pixel_w, 5):
-                        pygame.draw.line(screen, DARK_BROWN, 
-                                        (tx, y + pixel_h//4), 
-                                        (tx, y + 3*pixel_h//4), 1)
-
-        # Draw smoke particles
-        for particle in self.smoke_particles:
-            smoke_surface = pygame.Surface((6, 6), pygame.SRCALPHA)
-            pygame.draw.circle(smoke_surface, (100, 100, 100, particle["alpha"]), (3, 3), 3)
-            screen.blit(smoke_surface, (int(particle["x"]), int(particle["y"])))
+                    sprite = self.sprites.get((code, active, is_vertical, tile_size))
+                    if sprite is None:
+                        sprite = self.build_sprite(code, active, is_vertical, tile_size)
+                    screen.blit(sprite, (x, y - SPRITE_MARGIN // scale))
+
+        if frame.overlay:
+            self.draw_overlay(screen, frame.overlay)
+
+        if self.preview_mode and self.current_building in BUILDINGS:
+            self.draw_placement_preview(screen, frame)
+
+        # Draw smoke particles (too small to see at far zoom)
+        if tile_size > TILE_LOD_SIZE:
+            radius = max(1, 3 // scale)
+            for smoke_x, smoke_y, alpha in frame.smoke:
+                smoke_surface = pygame.Surface((radius * 2, radius * 2), pygame.SRCALPHA)
+                pygame.draw.circle(smoke_surface, (100, 100, 100, alpha), (radius, radius), radius)
+                screen.blit(smoke_surface, (int((smoke_x - camera_x) / scale), int((smoke_y - camera_y) / scale)))
 
         # Draw UI
-        resource_text = self.font.render(f"Resources: ${self.resources:.1f}", True, BLACK)
-        pollution_text = self.font.render(f"Pollution: {int(self.pollution)}", True, BLACK)
-        workers_text = self.font.render(f"Workers: {self.available_workers}/{self.total_workers}", True, BLACK)
+        resource_text = self.font.render(f"Resources: ${frame.resources:.1f}", True, BLACK)
+        pollution_text = self.font.render(f"Pollution: {int(frame.pollution)}", True, BLACK)
+        workers_text = self.font.render(f"Workers: {frame.available_workers}/{frame.total_workers}", True, BLACK)
         building_text = self.font.render(f"Building: {self.current_building}", True, BLACK)
         
-        inst_line1 = self.font.render("1: House  2: Farm  3: Mine  4: Factory  5: Railroad  T: Tech", True, BLACK)
+        inst_line0 = self.font.render("T: Tech  P: Fit  O: Overlay", True, BLACK)
+        inst_line1 = self.font.render("1: House  2: Farm  3: Mine  4: Factory  5: Railroad  6: Bulldoze", True, BLACK)
+        costs, tuning = frame.costs, frame.tuning
         inst_line2 = self.font.render(
-            f"${BUILDINGS['house']['current_cost']},+{HOUSE_CAPACITY}W  "
-            f"${BUILDINGS['farm']['current_cost']},{WORKERS_PER_FARM}W  "
-            f"${BUILDINGS['mine']['current_cost']},{WORKERS_PER_MINE}W  "
-            f"${BUILDINGS['factory']['current_cost']},{WORKERS_PER_FACTORY}W  "
-            f"${BUILDINGS['railroad']['current_cost']}",
+            f"${costs['house']},+{tuning['HOUSE_CAPACITY']}W  "
+            f"${costs['farm']},{tuning['WORKERS_PER_FARM']}W  "
+            f"${costs['mine']},{tuning['WORKERS_PER_MINE']}W  "
+            f"${costs['factory']},{tuning['WORKERS_PER_FACTORY']}W  "
+            f"${costs['railroad']}",
             True, BLACK
         )
 
@@ -570,64 +2483,536 @@ class CityBuilder:
         screen.blit(pollution_text, (10, 50))
         screen.blit(workers_text, (10, 90))
         screen.blit(building_text, (10, 130))
+        if self.idle_ms:
+            idle_seconds = self.idle_ms // 1000
+            idle_text = self.tech_font.render(f"Idle {idle_seconds // 60}m {idle_seconds % 60:02d}s", True, BLACK)
+            screen.blit(idle_text, (10, 170))
+        if frame.overlay:
+            self.draw_overlay_legend(screen, frame.overlay[0], 10, 195)
+        screen.blit(inst_line0, (10, HEIGHT - 120))
         screen.blit(inst_line1, (10, HEIGHT - 80))
         screen.blit(inst_line2, (10, HEIGHT - 40))
 
+        self.draw_minimap(screen)
+        if self.graphs_open:
+            for i, graph in enumerate(self.graphs):
+                graph.draw(screen, WIDTH - GRAPH_WIDTH - 10, MINIMAP_Y + MINIMAP_HEIGHT + 12 + i * (GRAPH_HEIGHT + 8))
+
         if self.tech_menu_open:
-            self.draw_tech_menu(screen)
-
-# Game instance
-game = CityBuilder()
-
-# Main game loop
-running = True
-clock = pygame.time.Clock()
-
-while running:
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            running = False
-        elif event.type == pygame.MOUSEBUTTONDOWN and not game.tech_menu_open:
-            x, y = pygame.mouse.get_pos()
-            game.add_building(x, y)
-        elif event.type == pygame.KEYDOWN:
-            if event.key == pygame.K_t:
-                game.tech_menu_open = not game.tech_menu_open
-            elif game.tech_menu_open:
-                if event.key == pygame.K_1:
-                    game.research_technology(0)
-                elif event.key == pygame.K_2:
-                    game.research_technology(1)
-                elif event.key == pygame.K_3:
-                    game.research_technology(2)
-                elif event.key == pygame.K_4:
-                    game.research_technology(3)
-                elif event.key == pygame.K_5:
-                    game.research_technology(4)
-                elif event.key == pygame.K_6:
-                    game.research_technology(5)
-                elif event.key == pygame.K_7:
-                    game.research_technology(6)
-                elif event.key == pygame.K_8:
-                    game.research_technology(7)
+            self.draw_tech_menu(screen, frame)
+
+class SimulationThread(threading.Thread):
+    # Steps the simulation at a fixed rate, independent of the frame rate
+    def __init__(self, game):
+        super().__init__(daemon=True)
+        self.game = game
+        self.running = True
+
+    def run(self):
+        game = self.game
+        next_step = time.perf_counter()
+        while self.running:
+            game.wake.clear()
+            game.step()
+            if game.is_idle():
+                # Sleep until the next timer is due; post() wakes us early
+                game.wake.wait(max(0, game.next_wake - game.get_ticks()) / 1000)
+                next_step = time.perf_counter()
+                continue
+            next_step += SIM_TICK / 1000
+            delay = next_step - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_step = time.perf_counter()  # Running behind; don't try to catch up
+
+    def stop(self):
+        self.running = False
+        self.game.wake.set()
+        self.join()
+
+def write_save(snapshot, path):
+    # Runs on the autosave thread. Building rows are converted in chunks with
+    # a yield between them so the render loop never waits long for the GIL;
+    # compression happens inside zlib, which releases the GIL.
+    buildings = snapshot["buildings"]
+    rows = np.empty((len(buildings), 3), dtype=np.int32)
+    for start in range(0, len(buildings), SAVE_CHUNK):
+        chunk = buildings[start:start + SAVE_CHUNK]
+        rows[start:start + len(chunk)] = [(b.code, b.grid_x, b.grid_y) for b in chunk]
+        time.sleep(0)
+    meta = {key: snapshot[key] for key in ("resources", "researched", "costs", "tuning", "seed")}
+
+    # Write to a temporary file and swap it in, so a crash mid-save never
+    # leaves a truncated save behind
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        np.savez_compressed(f, buildings=rows, grid=snapshot["grid"],
+                            pollution_field=snapshot["pollution_field"], meta=np.array(json.dumps(meta)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+def write_metrics(times, data, names, path):
+    # Runs on its own thread; the format follows the file extension
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if path.endswith(".npy"):
+        np.save(path, np.column_stack((times, data)))
+    else:
+        np.savetxt(path, np.column_stack((times, data)), delimiter=",", fmt="%.6g",
+                   header=",".join(["time_ms"] + names), comments="")
+
+def latest_autosave():
+    paths = [os.path.join(AUTOSAVE_DIR, f"autosave_{slot}.npz") for slot in range(AUTOSAVE_SLOTS)]
+    paths = [path for path in paths if os.path.exists(path)]
+    return max(paths, key=os.path.getmtime) if paths else None
+
+class SimulatedClock:
+    # Stands in for pygame.time.get_ticks so headless runs go as fast as the
+    # simulation allows
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return int(self.now)
+
+    def advance(self, ms):
+        self.now += ms
+
+def load_build_order(path):
+    # A build order is a list of timed actions, either bare or under "actions":
+    #   {"time": 0, "build": "house", "x": 80, "y": 58}
+    #   {"time": 0, "build": "railroad", "x": 70, "y": 62, "to": [90, 62]}
+    #   {"time": 30000, "research": "urban_housing"}
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            import yaml  # Only needed for YAML build orders
+            order = yaml.safe_load(f)
+        else:
+            order = json.load(f)
+    actions = order["actions"] if isinstance(order, dict) else order
+    for action in actions:
+        if "research" in action and action["research"] not in tech_list:
+            raise ValueError(f"Unknown technology {action['research']!r}")
+        if "build" in action and action["build"] not in BUILDINGS:
+            raise ValueError(f"Unknown building {action['build']!r}")
+    return sorted(actions, key=lambda action: action.get("time", 0))
+
+def apply_action(game, action):
+    if "research" in action:
+        game.post(game.research_by_key, action["research"])
+    elif "to" in action:
+        # Straight line of buildings, undone as one command like a track drag
+        x, y = action["x"], action["y"]
+        end_x, end_y = action["to"]
+        game.post(game.begin_command)
+        while True:
+            game.post(game.add_building_to_grid, x, y, action["build"])
+            if (x, y) == (end_x, end_y):
+                break
+            if x != end_x:
+                x += 1 if end_x > x else -1
+            else:
+                y += 1 if end_y > y else -1
+        game.post(game.end_command)
+    else:
+        game.post(game.add_building_to_grid, action["x"], action["y"], action["build"])
+
+def city_metrics(game, tick):
+    game.settle_districts()  # Coarse districts may hold cycles paid out at their next tick
+    return {
+        "tick": tick,
+        "time_ms": game.get_ticks(),
+        "resources": round(game.resources, 3),
+        "pollution": round(game.pollution, 3),
+        "total_workers": game.total_workers,
+        "available_workers": game.available_workers,
+        "buildings": {name: game.type_counts[code] for name, code in TYPE_CODES.items()},
+        "active_workplaces": sum(1 for b in game.buildings if b.code in WORKPLACES and b.active),
+        "researched": sorted(game.researched_technologies)
+    }
+
+def run_headless(args):
+    # ticks_per_second measures the simulation only; see headless_step
+    clock = SimulatedClock()
+    game = CityBuilder(clock=clock, autosave=False, seed=args.seed)
+    actions = load_build_order(args.headless)
+    next_action = 0
+    periodic = []
+
+    start = time.perf_counter()
+    for tick in range(1, args.ticks + 1):
+        clock.advance(args.tick_ms)
+        while next_action < len(actions) and actions[next_action].get("time", 0) <= clock():
+            apply_action(game, actions[next_action])
+            next_action += 1
+        game.headless_step()
+        if args.report_every and tick % args.report_every == 0:
+            periodic.append(city_metrics(game, tick))
+    wall_seconds = time.perf_counter() - start
+
+    result = {
+        "build_order": args.headless,
+        "ticks": args.ticks,
+        "tick_ms": args.tick_ms,
+        "wall_seconds": round(wall_seconds, 4),
+        "ticks_per_second": round(args.ticks / wall_seconds, 1) if wall_seconds else None,
+        "final": city_metrics(game, args.ticks),
+        "periodic": periodic
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+def encode_message(message):
+    payload = json.dumps(message, separators=(",", ":")).encode()
+    compressed = len(payload) > NET_COMPRESS_OVER
+    if compressed:
+        payload = zlib.compress(payload)
+    return NET_HEADER.pack(len(payload), compressed) + payload
+
+async def read_message(reader):
+    length, compressed = NET_HEADER.unpack(await reader.readexactly(NET_HEADER.size))
+    payload = await reader.readexactly(length)
+    return json.loads(zlib.decompress(payload) if compressed else payload)
+
+def is_valid_command(message):
+    # A whitelisted command with the number and types of arguments it
+    # takes. Types must match exactly, since a bool is also an int.
+    if not isinstance(message, dict):
+        return False
+    types = NET_COMMANDS.get(message.get("cmd"))
+    args = message.get("args", [])
+    return (types is not None and isinstance(args, list) and len(args) == len(types) and
+            all(type(arg) is expected for arg, expected in zip(args, types)))
+
+class CityServer:
+    # Authoritative server: owns the only simulated city, applies client
+    # commands and broadcasts batched deltas to every connected client
+    def __init__(self, game):
+        self.game = game
+        self.clients = set()
+        self.open_commands = {}  # Client writer -> its drag's open command
+        self.last_scalars = {}
+        self.tick = 0
+        game.journal = []
+        game.activity_changes = {}
+
+    def full_state(self):
+        game = self.game
+        return {"full": {
+            "buildings": [[b.code, b.grid_x, b.grid_y, b.active] for b in game.buildings],
+            "seed": game.terrain.seed,
+            "scalars": game.net_scalars()
+        }}
+
+    async def handle_client(self, reader, writer):
+        # A late joiner gets one full snapshot, then only deltas. Changes
+        # not yet broadcast go out to the others first, so the next delta
+        # can't repeat what the snapshot already holds.
+        self.broadcast(self.tick)
+        writer.write(encode_message(self.full_state()))
+        self.clients.add(writer)
+        try:
+            while True:
+                message = await read_message(reader)
+                if is_valid_command(message):
+                    self.game.post(self.run_command, writer, getattr(self.game, message["cmd"]),
+                                   message.get("args", []))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            self.game.post(self.run_command, writer, self.game.end_command, ())  # Keep a cut-off drag in history
+            writer.close()
+
+    def run_command(self, client, method, args):
+        # Each client drags on its own open command, so two drags at once
+        # don't end up in one history entry or replace each other
+        game = self.game
+        game.open_command = self.open_commands.pop(client, None)
+        try:
+            method(*args)
+        finally:
+            if game.open_command is not None:
+                self.open_commands[client] = game.open_command
+            game.open_command = None
+
+    def broadcast(self, tick):
+        delta = self.game.take_net_delta(self.last_scalars)
+        if not delta["changes"] and not delta["scalars"]:
+            return
+        delta["tick"] = tick
+        data = encode_message(delta)
+        for writer in list(self.clients):
+            if writer.is_closing():
+                self.clients.discard(writer)
+            else:
+                writer.write(data)
+
+    async def run(self, host, port):
+        server = await asyncio.start_server(self.handle_client, host, port)
+        print(f"Serving city on {host}:{port}")
+        async with server:
+            next_step = time.perf_counter()
+            while True:
+                self.game.headless_step(log_errors=True)
+                self.tick += 1
+                if self.tick % NET_BATCH == 0:
+                    self.broadcast(self.tick)
+                next_step += SIM_TICK / 1000
+                await asyncio.sleep(max(0.0, next_step - time.perf_counter()))
+
+def run_server(args):
+    # Clear the starting deltas so new clients only see them in the full snapshot
+    server = CityServer(CityBuilder(autosave=False, seed=args.seed))
+    server.game.take_net_delta(server.last_scalars)
+    try:
+        asyncio.run(server.run(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+class CityClient:
+    # Talks to a CityServer from a background asyncio thread. Updates are
+    # queued for the render loop; post() matches CityBuilder.post so the
+    # input handling can't tell a remote city from a local one.
+    def __init__(self, host, port):
+        self.updates = queue.SimpleQueue()
+        self.loop = asyncio.new_event_loop()
+        self.writer = None
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.connect(host, port), self.loop).result(timeout=10)
+
+    async def connect(self, host, port):
+        reader, self.writer = await asyncio.open_connection(host, port)
+        self.loop.create_task(self.receive(reader))
+
+    async def receive(self, reader):
+        try:
+            while True:
+                self.updates.put(await read_message(reader))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.updates.put(None)  # Server went away
+
+    def post(self, action, *args):
+        data = encode_message({"cmd": action.__name__, "args": list(args)})
+        self.loop.call_soon_threadsafe(self.writer.write, data)
+
+    def apply_updates(self, game):
+        # Returns False once the connection has closed
+        while True:
+            try:
+                message = self.updates.get_nowait()
+            except queue.Empty:
+                return True
+            if message is None:
+                return False
+            if "full" in message:
+                game.apply_net_full(message["full"])
             else:
-                if event.key == pygame.K_1:
-                    game.current_building = "house"
-                elif event.key == pygame.K_2:
-                    game.current_building = "farm"
-                elif event.key == pygame.K_3:
-                    game.current_building = "mine"
-                elif event.key == pygame.K_4:
-                    game.current_building = "factory"
-                elif event.key == pygame.K_5:
-                    game.current_building = "railroad"
-
-    game.assign_workers()
-    game.update_pollution()
-    game.produce_resources()
-    game.update_smoke()  # Update smoke particles
-    game.draw(screen)
-    pygame.display.flip()
-    clock.tick(60)
-
-pygame.quit()
\ No newline at end of file
+                for change in message["changes"]:
+                    game.apply_net_change(change)
+                game.apply_net_scalars(message["scalars"])
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+def run_window(client=None, idle_pacing=True, seed=0):
+    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    pygame.display.set_caption("Industrial Revolution City Builder")
+
+    # Game instance. With a client the city lives on the server and this
+    # one is only a mirror for drawing; commands go over the network.
+    game = CityBuilder(autosave=client is None, seed=seed)
+    if client:
+        game.post = client.post
+        simulation = None
+    else:
+        simulation = SimulationThread(game)
+        simulation.start()
+
+    # Main game loop
+    running = True
+    clock = pygame.time.Clock()
+    drag_tile = None  # Last tile of the track drag in progress
+    last_input = pygame.time.get_ticks()
+    waited = []  # Event that ended an idle wait, handled before the rest of the queue
+
+    while running:
+        events = waited + pygame.event.get()
+        if events:
+            last_input = pygame.time.get_ticks()
+        for event in events:
+            if event.type == pygame.QUIT:
+                running = False
+            elif event.type == pygame.MOUSEBUTTONDOWN and event.button <= 3 and not game.tech_menu_open:
+                # Buttons 4 and 5 are the wheel, which zooms (see MOUSEWHEEL)
+                x, y = pygame.mouse.get_pos()
+                if game.minimap_contains(x, y):
+                    game.jump_camera(x, y)
+                else:
+                    grid_x, grid_y = game.screen_to_grid(x, y)
+                    bulldozing = game.current_building == "bulldoze"
+                    if bulldozing or game.current_building == "railroad":
+                        # Track is laid and cleared by dragging; the whole drag undoes as one step
+                        drag_tile = (grid_x, grid_y)
+                        game.post(game.begin_command, bulldozing)
+                    if bulldozing:
+                        game.post(game.demolish_at, grid_x, grid_y)
+                    else:
+                        game.post(game.add_building_to_grid, grid_x, grid_y, game.current_building)
+            elif event.type == pygame.MOUSEMOTION and drag_tile:
+                grid_x, grid_y = game.screen_to_grid(*event.pos)
+                # Walk horizontally then vertically so fast drags leave no gaps
+                while drag_tile != (grid_x, grid_y):
+                    last_x, last_y = drag_tile
+                    if last_x != grid_x:
+                        drag_tile = (last_x + (1 if grid_x > last_x else -1), last_y)
+                    else:
+                        drag_tile = (last_x, last_y + (1 if grid_y > last_y else -1))
+                    if game.current_building == "bulldoze":
+                        game.post(game.demolish_at, drag_tile[0], drag_tile[1])
+                    else:
+                        game.post(game.add_building_to_grid, drag_tile[0], drag_tile[1], "railroad")
+            elif event.type == pygame.MOUSEBUTTONUP and event.button <= 3 and drag_tile:
+                drag_tile = None
+                game.post(game.end_command)
+            elif event.type == pygame.MOUSEWHEEL:
+                game.set_zoom(game.zoom - event.y, *pygame.mouse.get_pos())
+            elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_t:
+                    game.tech_menu_open = not game.tech_menu_open
+                elif event.key == pygame.K_z and event.mod & pygame.KMOD_CTRL:
+                    game.post(game.undo)
+                elif event.key == pygame.K_y and event.mod & pygame.KMOD_CTRL:
+                    game.post(game.redo)
+                elif event.key == pygame.K_g:
+                    game.graphs_open = not game.graphs_open
+                elif event.key == pygame.K_p:
+                    game.preview_mode = not game.preview_mode
+                elif event.key == pygame.K_o and not client:
+                    # Off, then each overlay in turn. The simulation builds
+                    # the layer, so wake it in case it's idle. A client's
+                    # mirror doesn't have the pollution field, rail network
+                    # or worker buckets the layers come from, so it has none.
+                    names = [None] + list(OVERLAYS)
+                    game.overlay = names[(names.index(game.overlay) + 1) % len(names)]
+                    game.wake.set()
+                elif event.key in (pygame.K_EQUALS, pygame.K_PLUS, pygame.K_KP_PLUS):
+                    game.set_zoom(game.zoom - 1, WIDTH // 2, HEIGHT // 2)
+                elif event.key in (pygame.K_MINUS, pygame.K_KP_MINUS):
+                    game.set_zoom(game.zoom + 1, WIDTH // 2, HEIGHT // 2)
+                elif event.key == pygame.K_e:
+                    stamp = time.strftime("%Y%m%d-%H%M%S")
+                    game.recorder.export(os.path.join(EXPORT_DIR, f"metrics-{stamp}.csv"))
+                    game.recorder.export(os.path.join(EXPORT_DIR, f"metrics-{stamp}.npy"))
+                elif event.key == pygame.K_F9:
+                    path = latest_autosave()
+                    if path:
+                        game.post(game.load_game, path)
+                elif game.tech_menu_open:
+                    if event.key == pygame.K_1:
+                        game.post(game.research_technology, 0)
+                    elif event.key == pygame.K_2:
+                        game.post(game.research_technology, 1)
+                    elif event.key == pygame.K_3:
+                        game.post(game.research_technology, 2)
+                    elif event.key == pygame.K_4:
+                        game.post(game.research_technology, 3)
+                    elif event.key == pygame.K_5:
+                        game.post(game.research_technology, 4)
+                    elif event.key == pygame.K_6:
+                        game.post(game.research_technology, 5)
+                    elif event.key == pygame.K_7:
+                        game.post(game.research_technology, 6)
+                    elif event.key == pygame.K_8:
+                        game.post(game.research_technology, 7)
+                else:
+                    if event.key == pygame.K_1:
+                        game.current_building = "house"
+                    elif event.key == pygame.K_2:
+                        game.current_building = "farm"
+                    elif event.key == pygame.K_3:
+                        game.current_building = "mine"
+                    elif event.key == pygame.K_4:
+                        game.current_building = "factory"
+                    elif event.key == pygame.K_5:
+                        game.current_building = "railroad"
+                    elif event.key == pygame.K_6:
+                        game.current_building = "bulldoze"
+
+        if client:
+            running = client.apply_updates(game) and running
+            game.update_smoke()
+            game.publish_frame()
+
+        keys = pygame.key.get_pressed()
+        speed = CAMERA_SPEED * GRID_SIZE // game.tile_size  # Same screen speed at every zoom
+        dx = (keys[pygame.K_RIGHT] - keys[pygame.K_LEFT]) * speed
+        dy = (keys[pygame.K_DOWN] - keys[pygame.K_UP]) * speed
+        if dx or dy or drag_tile:
+            last_input = pygame.time.get_ticks()
+        game.move_camera(dx, dy)
+        frame_start = time.perf_counter()
+        game.draw(screen)
+        pygame.display.flip()
+        game.frame_ms = (time.perf_counter() - frame_start) * 1000
+
+        # Idle: no input for a while and nothing animating. Block in
+        # event.wait instead of ticking at 60, so any input wakes the loop
+        # at once; otherwise redraw at IDLE_FPS, or sooner when a
+        # simulation timer is due.
+        now = pygame.time.get_ticks()
+        game.idle_ms = now - last_input if now - last_input >= IDLE_AFTER else 0
+        waited = []
+        if idle_pacing and game.idle_ms and not game.frames.read().smoke:
+            timeout = 1000 // IDLE_FPS
+            if game.next_wake is not None:
+                timeout = max(1, min(timeout, game.next_wake - now))
+            event = pygame.event.wait(timeout)
+            if event.type != pygame.NOEVENT:
+                waited = [event]
+            clock.tick()  # Keep the clock's frame timer current for when we wake
+        else:
+            clock.tick(60)
+
+    if simulation:
+        simulation.stop()
+    if client:
+        client.close()
+    if game.autosave_thread:
+        game.autosave_thread.join()
+    pygame.quit()
+
+def main():
+    parser = argparse.ArgumentParser(description="Industrial Revolution City Builder")
+    parser.add_argument("--headless", metavar="BUILD_ORDER",
+                        help="run a JSON or YAML build order without a window and print metrics")
+    parser.add_argument("--ticks", type=int, default=3600, help="simulation steps to run headless")
+    parser.add_argument("--tick-ms", type=float, default=SIM_TICK, help="simulated milliseconds per step")
+    parser.add_argument("--report-every", type=int, default=600, help="steps between periodic metrics (0: none)")
+    parser.add_argument("--seed", type=int, default=0, help="terrain seed")
+    parser.add_argument("--out", help="write metrics JSON here instead of stdout")
+    parser.add_argument("--server", action="store_true", help="host a shared city for multiplayer clients")
+    parser.add_argument("--host", default="127.0.0.1", help="address the server listens on")
+    parser.add_argument("--port", type=int, default=NET_PORT, help="port the server listens on")
+    parser.add_argument("--connect", metavar="HOST:PORT", help="join a shared city instead of playing alone")
+    parser.add_argument("--no-idle-pacing", dest="idle_pacing", action="store_false",
+                        help="always redraw at 60 fps, even when idle")
+    args = parser.parse_args()
+    if args.headless:
+        run_headless(args)
+    elif args.server:
+        run_server(args)
+    elif args.connect:
+        host, _, port = args.connect.rpartition(":")
+        run_window(CityClient(host or "127.0.0.1", int(port)), args.idle_pacing)
+    else:
+        run_window(idle_pacing=args.idle_pacing, seed=args.seed)
+
+if __name__ == "__main__":
+    main()
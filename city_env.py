@@ -0,0 +1,270 @@
+# Step/reset environment over the headless game, for automated players.
+#
+# CityEnv runs one city, with the same reset() and step() signatures as a
+# Gymnasium environment. VectorCityEnv runs one CityEnv per worker process
+# and keeps every observation in multiprocessing.shared_memory, so the
+# caller gets NumPy views of the workers' output without copying it.
+#
+#   envs = VectorCityEnv(8, seed=0)
+#   observations, infos = envs.reset()
+#   observations, rewards, terminated, truncated, infos = envs.step(actions)
+#   envs.close()
+#
+# An action is (kind, x, y): kind 0 waits, 1-5 build that type code at
+# tile x, y, 6 demolishes the building there, and 7 + i researches
+# technology i (x, y are ignored). The reward is the change in resources.
+import os
+
+# Dummy SDL drivers have to be picked before pygame loads
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import importlib.util
+import multiprocessing
+import traceback
+from multiprocessing import shared_memory
+import numpy as np
+
+GAME_FILE = "Industrial Revolution City Builder 1p6.py"
+
+def load_game():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), GAME_FILE)
+    spec = importlib.util.spec_from_file_location("city", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+city = load_game()
+
+WAIT = 0
+DEMOLISH = len(city.BUILDING_TYPES)  # Right after the building type codes
+RESEARCH = DEMOLISH + 1  # First research action; one per technology after it
+ACTION_NVEC = (RESEARCH + len(city.tech_list), city.GRID_WIDTH, city.GRID_HEIGHT)
+OBS_SCALARS = ("resources", "pollution", "available_workers", "total_workers", "buildings", "researched")
+OBSERVATION_LAYOUT = {  # Name -> (shape, dtype) of one city's observation
+    "grid": ((city.GRID_WIDTH, city.GRID_HEIGHT), np.int8),
+    "scalars": ((len(OBS_SCALARS),), np.float64)
+}
+
+# The game keeps costs and research effects in module globals, so a reset
+# has to put them back. That's also why each city needs its own process.
+START_TUNING = {name: getattr(city, name) for name in city.TUNING_NAMES}
+
+def reset_globals():
+    for spec in city.BUILDINGS.values():
+        spec["current_cost"] = spec["base_cost"]
+    for name, value in START_TUNING.items():
+        setattr(city, name, value)
+
+def empty_observation():
+    return {name: np.zeros(shape, dtype) for name, (shape, dtype) in OBSERVATION_LAYOUT.items()}
+
+class CityEnv:
+    # One headless city. Each step applies an action, then runs
+    # ticks_per_step simulation steps of tick_ms simulated milliseconds.
+    # The episode is truncated after max_steps; nothing ends it earlier.
+    # observation, if given, holds the arrays to write observations into
+    # (for VectorCityEnv, views of shared memory).
+    def __init__(self, ticks_per_step=60, tick_ms=city.SIM_TICK, max_steps=1000, observation=None):
+        self.ticks_per_step = ticks_per_step
+        self.tick_ms = tick_ms
+        self.max_steps = max_steps
+        self.observation = observation if observation is not None else empty_observation()
+        self.seed = 0
+        self.game = None
+        self.clock = None
+        self.steps = 0
+        self.ticks = 0
+
+    @property
+    def action_space(self):
+        from gymnasium import spaces  # Only needed by callers that ask for spaces
+        return spaces.MultiDiscrete(ACTION_NVEC)
+
+    @property
+    def observation_space(self):
+        from gymnasium import spaces
+        return spaces.Dict({
+            "grid": spaces.Box(city.EMPTY, city.RAILROAD, OBSERVATION_LAYOUT["grid"][0], np.int8),
+            "scalars": spaces.Box(-np.inf, np.inf, OBSERVATION_LAYOUT["scalars"][0], np.float64)
+        })
+
+    def reset(self, seed=None, options=None):
+        # seed picks the terrain; None reuses the last one
+        if seed is not None:
+            self.seed = seed
+        reset_globals()
+        self.clock = city.SimulatedClock()
+        self.game = city.CityBuilder(clock=self.clock, autosave=False, seed=self.seed)
+        self.steps = 0
+        self.ticks = 0
+        return self.observe(), city.city_metrics(self.game, self.ticks)
+
+    def step(self, action):
+        game = self.game
+        before = game.resources
+        self.apply(action)
+        for _ in range(self.ticks_per_step):
+            self.clock.advance(self.tick_ms)
+            game.headless_step()  # No frames or smoke, which nothing here reads
+        self.steps += 1
+        self.ticks += self.ticks_per_step
+        info = city.city_metrics(game, self.ticks)  # Settles districts, so resources are exact
+        truncated = self.steps >= self.max_steps
+        return self.observe(), game.resources - before, False, truncated, info
+
+    def apply(self, action):
+        # Posted like input, so it runs at the start of the next simulation step
+        kind, x, y = (int(value) for value in action)
+        game = self.game
+        if city.EMPTY < kind < DEMOLISH:
+            game.post(game.add_building_to_grid, x, y, city.BUILDING_TYPES[kind])
+        elif kind == DEMOLISH:
+            game.post(game.demolish_at, x, y)
+        elif kind >= RESEARCH:
+            game.post(game.research_technology, kind - RESEARCH)
+
+    def observe(self):
+        game = self.game
+        np.copyto(self.observation["grid"], game.grid)
+        self.observation["scalars"][:] = (game.resources, game.pollution, game.available_workers,
+                                          game.total_workers, len(game.buildings),
+                                          len(game.researched_technologies))
+        return self.observation
+
+def shared_arrays(blocks, num_envs):
+    # Observation arrays for num_envs cities, over the shared memory blocks
+    return {name: np.ndarray((num_envs,) + shape, dtype, buffer=blocks[name].buf)
+            for name, (shape, dtype) in OBSERVATION_LAYOUT.items()}
+
+def run_worker(pipe, block_names, num_envs, index, options):
+    # Worker process: steps one city, writing its observation straight
+    # into row index of the shared arrays, and answers over the pipe
+    blocks = {name: shared_memory.SharedMemory(name=block_name) for name, block_name in block_names.items()}
+    arrays = shared_arrays(blocks, num_envs)
+    env = CityEnv(observation={name: array[index] for name, array in arrays.items()}, **options)
+    try:
+        while True:
+            command, data = pipe.recv()
+            if command == "reset":
+                _, info = env.reset(seed=data)
+                pipe.send(("ok", info))
+            elif command == "step":
+                _, reward, terminated, truncated, info = env.step(data)
+                if terminated or truncated:
+                    # Start the next episode at once. The reset overwrites the
+                    # shared row, so the last observation goes in info as a copy.
+                    final_observation = {name: array.copy() for name, array in env.observation.items()}
+                    _, reset_info = env.reset()
+                    reset_info["final_observation"] = final_observation
+                    reset_info["final_info"] = info
+                    info = reset_info
+                pipe.send(("ok", (reward, terminated, truncated, info)))
+            elif command == "close":
+                break
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        pipe.send(("error", traceback.format_exc()))
+    finally:
+        del env, arrays  # Views have to go before the blocks can close
+        for block in blocks.values():
+            block.close()
+
+class VectorCityEnv:
+    # num_envs cities, one per worker process. reset() and step() return
+    # the same shared arrays every time ({"grid": (num_envs, w, h),
+    # "scalars": (num_envs, k)}), overwritten by the next call, so copy
+    # anything that has to outlive a step. A finished city starts a new
+    # episode within the same step; its last observation and metrics are
+    # in that city's info as "final_observation" and "final_info".
+    def __init__(self, num_envs, seed=0, context=None, **options):
+        self.num_envs = num_envs
+        self.seed = seed
+        self.closed = False
+        context = multiprocessing.get_context(context)
+        self.blocks = {}
+        for name, (shape, dtype) in OBSERVATION_LAYOUT.items():
+            size = num_envs * int(np.prod(shape)) * np.dtype(dtype).itemsize
+            self.blocks[name] = shared_memory.SharedMemory(create=True, size=size)
+        self.observations = shared_arrays(self.blocks, num_envs)
+        for array in self.observations.values():
+            array[:] = 0
+        block_names = {name: block.name for name, block in self.blocks.items()}
+
+        self.pipes = []
+        self.processes = []
+        for index in range(num_envs):
+            pipe, worker_pipe = context.Pipe()
+            process = context.Process(target=run_worker, args=(worker_pipe, block_names, num_envs, index, options),
+                                      daemon=True)
+            process.start()
+            worker_pipe.close()
+            self.pipes.append(pipe)
+            self.processes.append(process)
+
+    @property
+    def single_action_space(self):
+        from gymnasium import spaces
+        return spaces.MultiDiscrete(ACTION_NVEC)
+
+    @property
+    def action_space(self):
+        from gymnasium import spaces
+        return spaces.MultiDiscrete(np.tile(ACTION_NVEC, (self.num_envs, 1)))
+
+    def receive(self):
+        results = []
+        for pipe in self.pipes:
+            status, result = pipe.recv()
+            if status == "error":
+                self.close()
+                raise RuntimeError(f"city worker failed:\n{result}")
+            results.append(result)
+        return results
+
+    def reset(self, seed=None, options=None):
+        # City i gets seed + i, so every city has its own terrain
+        if seed is not None:
+            self.seed = seed
+        for index, pipe in enumerate(self.pipes):
+            pipe.send(("reset", self.seed + index))
+        return self.observations, self.receive()
+
+    def step(self, actions):
+        # actions: (num_envs, 3) array of (kind, x, y)
+        for pipe, action in zip(self.pipes, np.asarray(actions).tolist()):
+            pipe.send(("step", action))
+        results = self.receive()
+        rewards = np.array([result[0] for result in results], dtype=np.float64)
+        terminated = np.array([result[1] for result in results])
+        truncated = np.array([result[2] for result in results])
+        return self.observations, rewards, terminated, truncated, [result[3] for result in results]
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for pipe, process in zip(self.pipes, self.processes):
+            if process.is_alive():
+                try:
+                    pipe.send(("close", None))
+                except OSError:
+                    pass
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        for pipe in self.pipes:
+            pipe.close()
+        self.observations = None
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
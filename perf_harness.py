@@ -0,0 +1,255 @@
+# Frame-time regression harness for the game versions in this folder.
+#
+# Loads every "Industrial Revolution City Builder <N>p<M>.py" (or the files
+# given) headlessly, builds the same city in each and renders frames
+# offscreen, timing only draw(). Reports per-version frame-time
+# percentiles and draw calls per frame, and exits with status 1 when a
+# version is slower than the one before it by more than --threshold.
+#
+#   python perf_harness.py --frames 600
+#   python perf_harness.py --city build.json --stat p95 --threshold 1.5
+import os
+
+# Dummy SDL drivers have to be picked before pygame loads
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import argparse
+import gc
+import glob
+import importlib.util
+import inspect
+import json
+import random
+import re
+import sys
+import time
+import numpy as np
+import pygame
+
+VERSION_GLOB = "Industrial Revolution City Builder *.py"
+VERSION_PATTERN = re.compile(r"(\d+)p(\d+)\.py$")
+DRAW_FUNCTIONS = ("rect", "polygon", "line", "lines", "aaline", "aalines", "circle", "ellipse", "arc")
+SYNTHETIC_TYPES = ("house", "house", "house", "farm", "mine", "factory", "railroad", "railroad")
+STATS = ("mean", "p50", "p95", "p99", "max")
+FRAME_MS = 1000 / 60  # Simulated time between frames, for smoke and other animation
+
+def version_key(path):
+    match = VERSION_PATTERN.search(path)
+    return (int(match.group(1)), int(match.group(2))) if match else (0, 0)
+
+def version_name(path):
+    match = VERSION_PATTERN.search(path)
+    return f"{match.group(1)}p{match.group(2)}" if match else os.path.basename(path)
+
+def load_version(path):
+    # Older versions run their game loop at import time. Hand them a QUIT
+    # event so the loop ends after one pass, and keep the pygame.quit()
+    # after it from shutting pygame down under the next version.
+    spec = importlib.util.spec_from_file_location("city_" + version_name(path), path)
+    module = importlib.util.module_from_spec(spec)
+    get_events, quit_pygame = pygame.event.get, pygame.quit
+    pygame.event.get = lambda *args, **kwargs: [pygame.event.Event(pygame.QUIT)]
+    pygame.quit = lambda: None
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        pygame.event.get, pygame.quit = get_events, quit_pygame
+    return module
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return int(self.now)
+
+class CountingSurface(pygame.Surface):
+    # Offscreen screen that counts what is blitted or filled onto it
+    def __init__(self, size):
+        super().__init__(size)
+        self.calls = 0
+
+    def blit(self, *args, **kwargs):
+        self.calls += 1
+        return super().blit(*args, **kwargs)
+
+    def fill(self, *args, **kwargs):
+        self.calls += 1
+        return super().fill(*args, **kwargs)
+
+def synthetic_city(width, height, density, seed):
+    # Random buildings over the visible area, the same for every version
+    rng = random.Random(seed)
+    tiles = [(x, y) for x in range(width) for y in range(height)]
+    rng.shuffle(tiles)
+    return [(rng.choice(SYNTHETIC_TYPES), x, y) for x, y in tiles[:int(len(tiles) * density)]]
+
+def recorded_city(path):
+    # Builds from a headless build order (see run_headless in 1p6), moved
+    # so its top-left corner is at 0, 0. Research actions are skipped.
+    with open(path) as f:
+        order = json.load(f)
+    placements = []
+    for action in order["actions"] if isinstance(order, dict) else order:
+        if "build" not in action:
+            continue
+        x, y = action["x"], action["y"]
+        end_x, end_y = action.get("to", (x, y))
+        while True:
+            placements.append((action["build"], x, y))
+            if (x, y) == (end_x, end_y):
+                break
+            if x != end_x:
+                x += 1 if end_x > x else -1
+            else:
+                y += 1 if end_y > y else -1
+    left = min(x for _, x, _ in placements)
+    top = min(y for _, _, y in placements)
+    return [(building_type, x - left, y - top) for building_type, x, y in placements]
+
+def build_city(module, placements):
+    # Newer versions take a clock and can skip autosaving; pass what fits
+    options = inspect.signature(module.CityBuilder).parameters
+    clock = SimulatedClock()
+    kwargs = {}
+    if "clock" in options:
+        kwargs["clock"] = clock
+    if "autosave" in options:
+        kwargs["autosave"] = False
+    game = module.CityBuilder(**kwargs)
+
+    # Place relative to the top-left visible tile so every version shows the same city
+    origin_x = getattr(game, "camera_x", 0) // module.GRID_SIZE
+    origin_y = getattr(game, "camera_y", 0) // module.GRID_SIZE
+    game.resources = float("inf")
+    placed = 0
+    for building_type, x, y in placements:
+        before = len(game.buildings)
+        game.add_building_to_grid(origin_x + x, origin_y + y, building_type)
+        placed += len(game.buildings) > before
+    game.resources = 1e9  # Finite again so the HUD can format it
+    game.assign_workers()
+    return game, clock, placed
+
+def render_frame(game, clock, screen):
+    # Advance animation outside the timed region, then time draw() alone
+    clock.now += FRAME_MS
+    if hasattr(game, "update_smoke"):
+        game.update_smoke()
+    if hasattr(game, "publish_frame"):
+        game.publish_frame()
+    start = time.perf_counter()
+    game.draw(screen)
+    return (time.perf_counter() - start) * 1000
+
+def count_draw_calls(game, clock, screen):
+    # One frame with every pygame.draw function wrapped in a counter. Kept
+    # out of the timed frames so the wrappers don't skew them.
+    counts = {"draw": 0}
+    originals = {name: getattr(pygame.draw, name) for name in DRAW_FUNCTIONS}
+
+    def counted(function):
+        def wrapper(*args, **kwargs):
+            counts["draw"] += 1
+            return function(*args, **kwargs)
+        return wrapper
+
+    for name, function in originals.items():
+        setattr(pygame.draw, name, counted(function))
+    screen.calls = 0
+    try:
+        render_frame(game, clock, screen)
+    finally:
+        for name, function in originals.items():
+            setattr(pygame.draw, name, function)
+    return counts["draw"], screen.calls
+
+def benchmark(path, placements, frames, warmup):
+    module = load_version(path)
+    game, clock, placed = build_city(module, placements)
+    screen = CountingSurface((module.WIDTH, module.HEIGHT))
+    for _ in range(warmup):
+        render_frame(game, clock, screen)
+    draw_calls, blits = count_draw_calls(game, clock, screen)
+
+    times = np.empty(frames)
+    gc.collect()
+    gc.disable()
+    try:
+        for i in range(frames):
+            times[i] = render_frame(game, clock, screen)
+    finally:
+        gc.enable()
+    return {
+        "version": version_name(path),
+        "path": path,
+        "buildings": len(game.buildings),
+        "placed": placed,
+        "frames": frames,
+        "mean": float(times.mean()),
+        "p50": float(np.percentile(times, 50)),
+        "p95": float(np.percentile(times, 95)),
+        "p99": float(np.percentile(times, 99)),
+        "max": float(times.max()),
+        "draw_calls": draw_calls,
+        "blits": blits
+    }
+
+def find_regressions(results, stat, threshold):
+    # Each version is compared with the one before it
+    regressions = []
+    for previous, current in zip(results, results[1:]):
+        ratio = current[stat] / previous[stat]
+        current["ratio"] = ratio
+        if ratio > threshold:
+            regressions.append((previous["version"], current["version"], ratio))
+    return regressions
+
+def print_report(results, stat):
+    print(f"{'version':<10}{'buildings':>10}" + "".join(f"{name + ' ms':>10}" for name in STATS) +
+          f"{'draws':>8}{'blits':>8}{'vs prev':>9}")
+    for result in results:
+        ratio = f"{result['ratio']:.2f}x" if "ratio" in result else "-"
+        print(f"{result['version']:<10}{result['buildings']:>10}" +
+              "".join(f"{result[name]:>10.3f}" for name in STATS) +
+              f"{result['draw_calls']:>8}{result['blits']:>8}{ratio:>9}")
+    print(f"(ratios compare {stat})")
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare draw times across game versions.")
+    parser.add_argument("versions", nargs="*", help=f"game files to compare, oldest first (default: {VERSION_GLOB!r})")
+    parser.add_argument("--frames", type=int, default=300, help="timed frames per version")
+    parser.add_argument("--warmup", type=int, default=60, help="untimed frames first, so smoke builds up")
+    parser.add_argument("--city", metavar="BUILD_ORDER", help="JSON build order to place instead of a random city")
+    parser.add_argument("--density", type=float, default=0.35, help="share of visible tiles tried by the random city")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the random city")
+    parser.add_argument("--stat", choices=STATS, default="p50", help="statistic compared between versions")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="fail when a version's stat exceeds the previous version's by this factor")
+    parser.add_argument("--out", help="also write the results as JSON here")
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    paths = args.versions or sorted(glob.glob(os.path.join(here, VERSION_GLOB)), key=version_key)
+    if not paths:
+        parser.error("no game versions found")
+    if args.city:
+        placements = recorded_city(args.city)
+    else:
+        # Every version shows at least an 800x600 view of 20-pixel tiles
+        placements = synthetic_city(40, 30, args.density, args.seed)
+
+    results = [benchmark(path, placements, args.frames, args.warmup) for path in paths]
+    regressions = find_regressions(results, args.stat, args.threshold)
+    print_report(results, args.stat)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"stat": args.stat, "threshold": args.threshold, "results": results}, f, indent=2)
+    for previous, current, ratio in regressions:
+        print(f"REGRESSION: {current} {args.stat} is {ratio:.2f}x {previous}", file=sys.stderr)
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()